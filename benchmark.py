@@ -0,0 +1,292 @@
+import argparse
+import datetime as dtt
+import decimal
+import itertools
+import json
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    from .db_loader import db, db_session, entities, use_definition
+    from .export import dependency_order, link_collections, table_columns
+    from . import cache, db_admin, metrics, pony_table, vis_pony
+except ModuleNotFoundError:
+    from db_loader import db, db_session, entities, use_definition
+    from export import dependency_order, link_collections, table_columns
+    import cache
+    import db_admin
+    import metrics
+    import pony_table
+    import vis_pony
+
+EXAMPLE = Path(__file__).parent / 'graph_examples' / 'complex_example.py'
+
+# rows per entity of graph_examples/complex_example.py at scale 1
+VOLUMES = {
+    'Table1': 100,
+    'Table2': 1000,
+    'Table3': 1000,
+    'Table4': 20000,
+    'Table5': 10000,
+    'Table6': 10000,
+    'Table7': 100000,
+    'Table8': 200,
+    'Table9': 100000,
+    'Table10': 1000,
+    'Table11': 1000000,
+    'Table12': 1000,
+    'Table13': 100,
+    'Table14': 20000,
+}
+# links per owner of every many-to-many collection
+FANOUT = 5
+INSERT_BATCH = 10000
+
+
+def write_definition(directory, database):
+    """
+    Writes a copy of the example definition that stores its tables in the
+    SQLite file database and returns its path.
+    """
+    source = EXAMPLE.read_text()
+    source = re.sub(r"filename=':memory:'", f'filename={str(database)!r}',
+                    source)
+    path = Path(directory) / 'benchmark_definition.py'
+    path.write_text(source)
+    return path
+
+
+def _is_one_to_one(attr):
+    return attr.py_type in entities.values() and \
+        not attr.reverse.is_collection
+
+
+def _value(attr, i, rng, counts, pools):
+    if attr.py_type in entities.values():
+        count = counts[attr.py_type.__name__]
+        if not count or (not attr.is_required and rng.random() < 0.2):
+            return None
+        if attr in pools:
+            # one-to-one: every target is referred to at most once
+            pool = pools[attr]
+            return pool.pop() if pool else None
+        return rng.randint(1, count)
+    elif attr.py_type is str:
+        return f'{attr.name} {i}'
+    elif attr.py_type is bool:
+        return rng.random() < 0.5
+    elif attr.py_type is decimal.Decimal:
+        return decimal.Decimal(rng.randint(-10 ** 6, 10 ** 6)) / 100
+    elif attr.py_type is dtt.datetime:
+        return dtt.datetime(2000, 1, 1) + dtt.timedelta(
+            minutes=rng.randint(0, 10 ** 7))
+    elif attr.py_type is int:
+        return rng.randint(0, 10 ** 6)
+    raise ValueError(f'Cannot generate {attr.py_type} values for {attr}')
+
+
+def _insert(table, columns, rows):
+    quote = db._db.provider.quote_name
+    sql = (f'INSERT INTO {quote(table)} '
+           f'({", ".join(quote(c) for c in columns)}) '
+           f'VALUES ({", ".join("?" * len(columns))})')
+    for start in range(0, len(rows), INSERT_BATCH):
+        with db_session:
+            db._db.get_connection().executemany(
+                sql, rows[start:start + INSERT_BATCH])
+            db._db.commit()
+
+
+def generate(volumes, fanout=FANOUT, seed=0, report=sys.stderr):
+    """
+    Fills the loaded database with volumes[entity] rows per entity, every
+    owner linked to fanout entries of each of its many-to-many collections.
+    Values are drawn from a random generator seeded with seed, so the same
+    arguments always give the same database. One-to-one references are
+    drawn without replacement, so an entity with a required one is capped
+    at the rows of its target. Rows are inserted with raw executemany
+    statements, as going through the entities would take far longer than
+    the benchmarks themselves.
+    """
+    rng = random.Random(seed)
+    counts = {entity: 0 for entity in entities}
+    for entity in dependency_order():
+        start = time.perf_counter()
+        attrs = [attr for attr in table_columns(entity) if attr.name != 'id']
+        converters = [attr.converters[0].py2sql for attr in attrs]
+        pools = {}
+        for attr in filter(_is_one_to_one, attrs):
+            pools[attr] = list(range(1, counts[attr.py_type.__name__] + 1))
+            rng.shuffle(pools[attr])
+        volume = min([volumes.get(entity, 0)] +
+                     [len(pools[attr]) for attr in pools if attr.is_required])
+        rows = []
+        for i in range(1, volume + 1):
+            values = [_value(attr, i, rng, counts, pools) for attr in attrs]
+            rows.append([None if v is None else convert(v)
+                         for convert, v in zip(converters, values)])
+        _insert(entities[entity]._table_, [a.column for a in attrs], rows)
+        counts[entity] = len(rows)
+        print(f'{entity}: {len(rows)} rows in '
+              f'{time.perf_counter() - start:.1f}s', file=report)
+    for attr in link_collections():
+        start = time.perf_counter()
+        owner = attr.entity.__name__
+        target = attr.py_type.__name__
+        owner_columns = attr.reverse_columns if attr.symmetric else \
+            attr.reverse.columns
+        links = set()
+        for owner_id in range(1, counts[owner] + 1):
+            k = min(fanout, counts[target])
+            for target_id in rng.sample(range(1, counts[target] + 1), k):
+                if attr.symmetric:
+                    if target_id != owner_id:
+                        links.add((owner_id, target_id))
+                        links.add((target_id, owner_id))
+                else:
+                    links.add((owner_id, target_id))
+        _insert(attr.table, [owner_columns[0], attr.columns[0]],
+                sorted(links))
+        print(f'{owner}.{attr.name}: {len(links)} links in '
+              f'{time.perf_counter() - start:.1f}s', file=report)
+    return counts
+
+
+def measure(name, func, repeat, setup=None):
+    """
+    Calls func repeat times, each after setup, and returns the wall time
+    statistics together with the SQL statements and rows of the last call.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with metrics.timed(f'benchmark:{name}') as frame:
+            func()
+        durations.append(time.perf_counter() - frame.start)
+    return {'repeat': repeat,
+            'min': min(durations),
+            'median': statistics.median(durations),
+            'mean': statistics.mean(durations),
+            'max': max(durations),
+            'sql_statements': frame.statements,
+            'rows_fetched': frame.rows}
+
+
+def run_benchmarks(counts, repeat=5):
+    """Times the db_admin hot paths and returns the results by name."""
+    table = pony_table.PonyTable('Table11')
+    middle = max(counts['Table11'] // 2, 1)
+    form = db_admin.EntryForm('Table11')
+    amounts = itertools.count()
+
+    def entry_args(id_, amount):
+        values = {'id': id_, 'amount': amount,
+                  'table10': '<Table10[1]>', 'table8': '<Table8[1]>',
+                  'table9s': [f'<Table9[{i}]>' for i in range(1, 4)]}
+        return [values[key] for key in table.table_cols]
+
+    benchmarks = [
+        ('get_table_summary', db_admin.get_table_summary, cache.clear),
+        ('get_table_summary_cached', db_admin.get_table_summary, None),
+        ('entry_dropdown_options',
+         lambda: db_admin._get_entry_dropdown_options('Table11'), None),
+        ('entry_dropdown_options_after',
+         lambda: db_admin._get_entry_dropdown_options('Table11',
+                                                      after=middle), None),
+        ('entry_dropdown_options_search',
+         lambda: db_admin._get_entry_dropdown_options('Table9', 'ion 99'),
+         None),
+        ('get_form_children', lambda: form.get_form_children(middle),
+         cache.clear),
+        ('get_form_children_cached', lambda: form.get_form_children(middle),
+         None),
+        ('calculate_graph', vis_pony.calculate_graph, None),
+    ]
+    results = {}
+    for name, func, setup in benchmarks:
+        results[name] = measure(name, func, repeat, setup)
+
+    # the entries added are modified and then deleted again, one per call
+    results['add_entry'] = measure(
+        'add_entry', lambda: table.add_entry(entry_args(None, '1.25')),
+        repeat)
+    with db_session:
+        added = list(db._db.select(
+            f'SELECT id FROM {entities["Table11"]._table_} '
+            'ORDER BY id DESC LIMIT $repeat', {'repeat': repeat}))
+    modified = iter(added)
+    results['modify_entry'] = measure(
+        'modify_entry', lambda: table.modify_entry(
+            entry_args(next(modified), str(next(amounts)))), repeat)
+    results['delete_entry'] = measure(
+        'delete_entry', lambda: table.delete_entry(
+            entry_args(added.pop(), '0')), repeat)
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(output='-', scale=1.0, fanout=FANOUT, seed=0, repeat=5,
+         report=sys.stderr):
+    """
+    Builds a temporary SQLite database from the example definition, fills
+    it at the given scale of VOLUMES, runs the benchmarks and writes the
+    results as JSON to output ('-' for stdout).
+    """
+    volumes = {entity: max(int(count * scale), 1)
+               for entity, count in VOLUMES.items()}
+    with tempfile.TemporaryDirectory() as directory:
+        definition = write_definition(directory,
+                                      Path(directory) / 'benchmark.sqlite')
+        use_definition(str(definition))
+        metrics.instrument_database(db._db)
+        start = time.perf_counter()
+        counts = generate(volumes, fanout, seed, report)
+        generate_seconds = time.perf_counter() - start
+        results = run_benchmarks(counts, repeat)
+        db._db.disconnect()
+    data = {'commit': _commit(),
+            'python': platform.python_version(),
+            'scale': scale, 'fanout': fanout, 'seed': seed,
+            'volumes': volumes,
+            'generate_seconds': generate_seconds,
+            'results': results}
+    text = json.dumps(data, indent=2)
+    if output == '-':
+        print(text)
+    else:
+        Path(output).write_text(text + '\n')
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the db_admin hot paths on a generated copy '
+                    'of graph_examples/complex_example.py')
+    parser.add_argument('--output', default='-',
+                        help="JSON file to write, '-' for stdout")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the row volumes, 1 gives 1M Table11 '
+                             'rows')
+    parser.add_argument('--fanout', type=int, default=FANOUT,
+                        help='links per owner of many-to-many collections')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='calls timed per benchmark')
+    args = parser.parse_args()
+    main(args.output, args.scale, args.fanout, args.seed, args.repeat)
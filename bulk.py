@@ -0,0 +1,596 @@
+import re
+import time
+from collections import Counter
+
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output, State
+from pony.orm.dbapiprovider import IntegrityError
+
+from mydash.component import Row, Col, Button
+
+try:
+    from .db_loader import db, entities
+    from .grid import grid_columns, parse_filter
+    from .metrics import session, read_session, timed
+    from .pony_table import PonyTable, IN_BATCH_SIZE, bump_versions, \
+        forget_labels, get_entries_from_reprs, _notify_bulk_write
+except ModuleNotFoundError:
+    from db_loader import db, entities
+    from grid import grid_columns, parse_filter
+    from metrics import session, read_session, timed
+    from pony_table import PonyTable, IN_BATCH_SIZE, bump_versions, \
+        forget_labels, get_entries_from_reprs, _notify_bulk_write
+
+_ID_RANGE = re.compile(r'^(\d+)(?:-(\d+))?$')
+# beyond this, rows are better chosen with a filter such as {id} > 100
+MAX_IDS = 100000
+
+
+def parse_ids(text):
+    """
+    Turns a list of ids and ranges such as '1, 4-6 9' into a list of at
+    most MAX_IDS ids.
+    """
+    ids = []
+    for part in re.split(r'[\s,]+', text.strip()):
+        if not part:
+            continue
+        match = _ID_RANGE.match(part)
+        if not match:
+            raise ValueError(f'Cannot parse id {part!r}')
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if last < first:
+            raise ValueError(f'Reversed id range {part!r}, write it as '
+                             f'{last}-{first}')
+        if len(ids) + last - first + 1 > MAX_IDS:
+            raise ValueError(f'More than {MAX_IDS} ids, choose the rows '
+                             'with a filter instead')
+        ids += range(first, last + 1)
+    return ids
+
+
+def _batches(ids):
+    """Yields the ids IN_BATCH_SIZE at a time, joined for an IN clause."""
+    for start in range(0, len(ids), IN_BATCH_SIZE):
+        yield ', '.join(str(int(id_))
+                        for id_ in ids[start:start + IN_BATCH_SIZE])
+
+
+def _execute(sql, params=None):
+    """Executes a write and returns the number of rows it changed."""
+    return db._db.execute(sql, params or {}).rowcount
+
+
+def _selection_sql(table_name, filter_query, ids):
+    """
+    Returns the SQL selecting the ids of the rows of table_name matching
+    filter_query, in the filter syntax of the grid, with its parameters,
+    and whether it has a WHERE clause.
+    """
+    if not filter_query and ids is None:
+        raise ValueError('Select the rows with a filter or a list of ids')
+    entity = entities[table_name]
+    quote = db._db.provider.quote_name
+    where, params = parse_filter(table_name, filter_query)
+    return (f'SELECT {quote(entity._pk_columns_[0])} '
+            f'FROM {quote(entity._table_)}{where}', params, bool(where))
+
+
+@session
+def select_ids(table_name, filter_query='', ids=None):
+    """
+    Returns the ids of the rows of table_name matching filter_query, in the
+    filter syntax of the grid, and among ids unless it is None. Selecting
+    every row needs a filter that matches them all.
+    """
+    sql, params, where = _selection_sql(table_name, filter_query, ids)
+    id_col = db._db.provider.quote_name(entities[table_name]._pk_columns_[0])
+    if ids is None:
+        return db._db.select(f'{sql} ORDER BY {id_col}', params)
+    found = []
+    for batch in _batches(sorted(set(ids))):
+        found += db._db.select(
+            f'{sql} {"AND" if where else "WHERE"} {id_col} IN ({batch}) '
+            f'ORDER BY {id_col}', params)
+    return found
+
+
+def _sql_value(table_name, column, value):
+    """
+    Validates value, given as the entry form gives it, for column and
+    returns it as stored in the database.
+    """
+    table = PonyTable(table_name)
+    attr = table.get_attribute(column.name)
+    if value in (None, ''):
+        if attr.is_required:
+            raise ValueError(f'{table_name}.{column.name} is required')
+        if column.kind is not table.STR:
+            return None
+    if column.kind is table.BOOL:
+        value = str(value).lower() in ('1', 'true', 'yes')
+    elif column.kind is table.REFERENCE:
+        value = get_entries_from_reprs([value])[value]
+        if value is None:
+            # a repr naming no entry, such as 'None', clears the reference
+            if attr.is_required:
+                raise ValueError(f'{table_name}.{column.name} is required')
+            return None
+    try:
+        value = attr.validate(value, entity=table.table)
+    except TypeError as error:
+        raise ValueError(str(error)) from error
+    if column.kind is table.REFERENCE:
+        return value.id
+    return attr.converters[0].py2sql(value)
+
+
+@session
+def _set_column(table_name, column_name, value, filter_query, ids):
+    table = PonyTable(table_name)
+    columns = {column.name: column for column in grid_columns(table_name)
+               if column.kind is not table.ID}
+    if column_name not in columns:
+        raise ValueError(f'{table_name}.{column_name} cannot be set in bulk')
+    sql_value = _sql_value(table_name, columns[column_name], value)
+    ids = select_ids(table_name, filter_query, ids)
+    if table.is_unique(column_name) and sql_value is not None and \
+            len(ids) > 1:
+        raise ValueError(f'{table_name}.{column_name} is unique, it cannot '
+                         f'be set to one value on {len(ids)} rows')
+    quote = db._db.provider.quote_name
+    entity = table.table
+    updated = 0
+    for batch in _batches(ids):
+        updated += _execute(
+            f'UPDATE {quote(entity._table_)} '
+            f'SET {quote(table.get_attribute(column_name).column)} = $value '
+            f'WHERE {quote(entity._pk_columns_[0])} IN ({batch})',
+            {'value': sql_value})
+    forget_labels(table_name, ids)
+    _notify_bulk_write('modify', table_name, ids)
+    bump_versions(table_name)
+    return updated
+
+
+def _report(frame, **counts):
+    return dict(counts, statements=frame.statements,
+                seconds=time.perf_counter() - frame.start)
+
+
+def bulk_set(table_name, column_name, value, filter_query='', ids=None):
+    """
+    Sets column_name to value, given as in the entry form, on the rows of
+    table_name chosen by select_ids. Runs in one transaction with one
+    UPDATE per IN_BATCH_SIZE rows and returns the number of rows updated
+    together with the SQL statements and seconds it took.
+    """
+    with timed('bulk:set') as frame:
+        updated = _set_column(table_name, column_name, value, filter_query,
+                              ids)
+    return _report(frame, updated=updated)
+
+
+def _reverse_edges(table_name):
+    """
+    Returns (action, attr) for every relationship of table_name that a
+    delete of its rows affects, action being what pony does with the
+    related rows: 'cascade' deletes them, 'nullify' clears their reference,
+    'unlink' removes the many-to-many links and 'refuse' stands for a
+    required reverse without cascade_delete, which forbids the delete.
+    """
+    edges = []
+    for attr in entities[table_name]._attrs_:
+        reverse = attr.reverse
+        if reverse is None:
+            continue
+        if attr.is_collection and reverse.is_collection:
+            edges.append(('unlink', attr))
+        elif attr.cascade_delete:
+            edges.append(('cascade', attr))
+        elif reverse.is_required:
+            edges.append(('refuse', attr))
+        elif reverse.columns:
+            edges.append(('nullify', attr))
+    return edges
+
+
+def _related_sql(attr, source):
+    """
+    Returns the SQL selecting the ids of the rows related through attr to
+    the rows whose ids are source, a list of ids or a subquery.
+    """
+    quote = db._db.provider.quote_name
+    reverse = attr.reverse
+    if reverse.columns:
+        other = reverse.entity
+        return (f'SELECT {quote(other._pk_columns_[0])} '
+                f'FROM {quote(other._table_)} '
+                f'WHERE {quote(reverse.columns[0])} IN ({source})')
+    entity = attr.entity
+    column = quote(attr.columns[0])
+    return (f'SELECT {column} FROM {quote(entity._table_)} '
+            f'WHERE {quote(entity._pk_columns_[0])} IN ({source}) '
+            f'AND {column} IS NOT NULL')
+
+
+def _related_ids(attr, ids):
+    """Returns the ids of the rows related to ids through attr."""
+    related = []
+    for batch in _batches(ids):
+        related += db._db.select(_related_sql(attr, batch))
+    return related
+
+
+def _link_condition(attr, source):
+    """Selects the links of the many-to-many attr of the rows source."""
+    quote = db._db.provider.quote_name
+    columns = [attr.reverse.columns[0]]
+    if attr.symmetric:
+        columns = [attr.columns[0], attr.reverse_columns[0]]
+    return ' OR '.join(f'{quote(column)} IN ({source})' for column in columns)
+
+
+def _unlink(attr, ids):
+    quote = db._db.provider.quote_name
+    unlinked = 0
+    for batch in _batches(ids):
+        unlinked += _execute(f'DELETE FROM {quote(attr.table)} '
+                             f'WHERE {_link_condition(attr, batch)}')
+    return unlinked
+
+
+def _nullify(attr, ids):
+    reverse = attr.reverse
+    other = reverse.entity
+    quote = db._db.provider.quote_name
+    nullified = 0
+    for batch in _batches(ids):
+        nullified += _execute(
+            f'UPDATE {quote(other._table_)} '
+            f'SET {quote(reverse.columns[0])} = NULL '
+            f'WHERE {quote(other._pk_columns_[0])} IN ({batch})')
+    forget_labels(other.__name__, ids)
+    _notify_bulk_write('modify', other.__name__, ids)
+    bump_versions(other.__name__)
+    return nullified
+
+
+def _delete_rows(table_name, ids, counts, pending):
+    """
+    Deletes the rows ids of table_name and handles their relationships the
+    way pony would, cascading to related rows through further calls.
+    pending holds the ids being deleted per table, so that cycles of
+    cascades end.
+    """
+    pending.setdefault(table_name, set()).update(ids)
+    later = []
+    for action, attr in _reverse_edges(table_name):
+        name = f'{table_name}.{attr.name}'
+        if action == 'unlink':
+            counts['unlinked'][name] += _unlink(attr, ids)
+            continue
+        related = _related_ids(attr, ids)
+        other = attr.py_type.__name__
+        if not related:
+            continue
+        elif action == 'refuse':
+            raise ValueError(f'Cannot delete {table_name} rows with '
+                             f'{attr.name}, as {attr.reverse} is required '
+                             f'and {attr} has no cascade_delete')
+        elif action == 'nullify':
+            counts['nullified'][name] += _nullify(attr, related)
+        else:
+            related = [id_ for id_ in related
+                       if id_ not in pending.get(other, ())]
+            if not related:
+                continue
+            if attr.reverse.columns:
+                _delete_rows(other, related, counts, pending)
+            else:
+                # the related rows are referred to by the rows deleted
+                later.append((other, related))
+
+    entity = entities[table_name]
+    quote = db._db.provider.quote_name
+    for batch in _batches(ids):
+        counts['deleted'][table_name] += _execute(
+            f'DELETE FROM {quote(entity._table_)} '
+            f'WHERE {quote(entity._pk_columns_[0])} IN ({batch})')
+    forget_labels(table_name, ids)
+    _notify_bulk_write('delete', table_name, ids)
+    bump_versions(table_name)
+    for other, related in later:
+        _delete_rows(other, related, counts, pending)
+
+
+@session
+def _delete(table_name, filter_query, ids):
+    counts = {'deleted': Counter(), 'nullified': Counter(),
+              'unlinked': Counter()}
+    ids = select_ids(table_name, filter_query, ids)
+    if ids:
+        _delete_rows(table_name, ids, counts, {})
+    return {key: dict(value) for key, value in counts.items()}
+
+
+def bulk_delete(table_name, filter_query='', ids=None):
+    """
+    Deletes the rows of table_name chosen by select_ids in one transaction.
+    Rather than loading every entry as pony's delete does, cascades,
+    cleared references and many-to-many links are handled with one
+    statement per relationship and IN_BATCH_SIZE rows. Returns the rows
+    deleted per table, nullified and unlinked per relationship, together
+    with the SQL statements and seconds it took. before_delete hooks of
+    the entities are not called.
+    """
+    with timed('bulk:delete') as frame:
+        counts = _delete(table_name, filter_query, ids)
+    return _report(frame, **counts)
+
+
+def _cascade_sql(attr, cycle, source, target):
+    """
+    Returns the recursive SELECT of the cycle CTE of _preview adding the
+    rows of entity number target cascaded to through attr from its rows of
+    entity number source.
+    """
+    quote = db._db.provider.quote_name
+    reverse = attr.reverse
+    if reverse.columns:
+        other = reverse.entity
+        return (f'SELECT {target}, r.{quote(other._pk_columns_[0])} '
+                f'FROM {cycle} c JOIN {quote(other._table_)} r '
+                f'ON r.{quote(reverse.columns[0])} = c.id '
+                f'WHERE c.entity = {source}')
+    entity = attr.entity
+    column = quote(attr.columns[0])
+    return (f'SELECT {target}, r.{column} '
+            f'FROM {cycle} c JOIN {quote(entity._table_)} r '
+            f'ON r.{quote(entity._pk_columns_[0])} = c.id '
+            f'WHERE c.entity = {source} AND r.{column} IS NOT NULL')
+
+
+def _components(tables, cascades):
+    """
+    Returns the strongly connected components of the cascades between
+    tables, in an order where cascades only go to later components or
+    within one, and tells for each whether it holds a cycle.
+    """
+    reach = {}
+    for table in tables:
+        seen, pending = set(), [table]
+        while pending:
+            name = pending.pop()
+            for source, _, target in cascades:
+                if source == name and target not in seen:
+                    seen.add(target)
+                    pending.append(target)
+        reach[table] = seen
+    components = []
+    for table in tables:
+        if not any(table in component for component, _ in components):
+            components.append(([other for other in tables if other == table
+                                or (table in reach[other] and
+                                    other in reach[table])],
+                               table in reach[table]))
+    ordered = []
+    done = set()
+    while components:
+        component = next(
+            component for component in components
+            if all(source in done or source in component[0]
+                   for source, _, target in cascades
+                   if target in component[0]))
+        components.remove(component)
+        ordered.append(component)
+        done.update(component[0])
+    return ordered
+
+
+@read_session
+def _preview(table_name, filter_query, ids):
+    root, params, where = _selection_sql(table_name, filter_query, ids)
+    if ids is not None:
+        id_col = db._db.provider.quote_name(
+            entities[table_name]._pk_columns_[0])
+        # IN (NULL) selects nothing when no ids are given
+        roots = [f'{root} {"AND" if where else "WHERE"} {id_col} '
+                 f'IN ({batch})'
+                 for batch in list(_batches(sorted(set(ids)))) or ['NULL']]
+    else:
+        roots = [root]
+    # every table reached is numbered and walked once
+    numbers = {table_name: 0}
+    cascades = []
+    reached = []
+    walked = [table_name]
+    for name in walked:
+        for action, attr in _reverse_edges(name):
+            if action != 'cascade':
+                reached.append((action, attr, name))
+                continue
+            other = attr.py_type.__name__
+            if other not in numbers:
+                numbers[other] = len(numbers)
+                walked.append(other)
+            cascades.append((name, attr, other))
+    # the rows deleted from table number n are those of the CTE dn, the
+    # union of the rows cascaded to from earlier tables. Tables cascading
+    # to each other share a recursive CTE of (number, id) rows
+    ctes = []
+    for component, cyclic in _components(walked, cascades):
+        sources = {name: list(roots) if name == table_name else []
+                   for name in component}
+        for source, attr, target in cascades:
+            if target in component and source not in component:
+                sources[target].append(_related_sql(
+                    attr, f'SELECT id FROM d{numbers[source]}'))
+        if not cyclic:
+            name, = component
+            ctes.append(f'd{numbers[name]}(id) AS '
+                        f'({" UNION ".join(sources[name])})')
+            continue
+        cycle = f'c{numbers[component[0]]}'
+        selects = [f'SELECT {numbers[name]}, * FROM ({source})'
+                   for name in component for source in sources[name]]
+        selects += [_cascade_sql(attr, cycle, numbers[source],
+                                 numbers[target])
+                    for source, attr, target in cascades
+                    if source in component and target in component]
+        ctes.append(f'{cycle}(entity, id) AS ({" UNION ".join(selects)})')
+        ctes += [f'd{numbers[name]}(id) AS '
+                 f'(SELECT id FROM {cycle} WHERE entity = {numbers[name]})'
+                 for name in component]
+    quote = db._db.provider.quote_name
+    counts = {key: {} for key in ('deleted', 'nullified', 'unlinked',
+                                  'refused')}
+    keys = [('deleted', name) for name in numbers]
+    columns = [f'SELECT COUNT(*) FROM d{number}'
+               for number in numbers.values()]
+    for action, attr, name in reached:
+        source = f'SELECT id FROM d{numbers[name]}'
+        if action == 'unlink':
+            columns.append(f'SELECT COUNT(*) FROM {quote(attr.table)} '
+                           f'WHERE {_link_condition(attr, source)}')
+        else:
+            columns.append(
+                f'SELECT COUNT(*) FROM ({_related_sql(attr, source)})')
+        # refusals are named after the required reference blocking them
+        named = attr.reverse if action == 'refuse' else attr
+        keys.append(({'unlink': 'unlinked', 'nullify': 'nullified',
+                      'refuse': 'refused'}[action],
+                     f'{named.entity.__name__}.{named.name}'))
+    # wrapped, as pony only runs raw SQL starting with SELECT
+    row = db._db.select(
+        f'SELECT * FROM (WITH RECURSIVE {", ".join(ctes)} '
+        f'SELECT {", ".join(f"({column})" for column in columns)})',
+        params)[0]
+    for (key, name), count in zip(keys, row if len(keys) > 1 else [row]):
+        counts[key][name] = count
+    return counts
+
+
+def preview_delete(table_name, filter_query='', ids=None):
+    """
+    Counts what bulk_delete(table_name, filter_query, ids) would change,
+    without changing anything, so it also previews delete_entry with a
+    single id. Relationships are followed as by bulk_delete, cascades
+    through one recursive query collecting the rows deleted, so no row is
+    loaded however many dependents there are. Each table and
+    relationship reached is walked once, and everything is counted by a
+    single statement. 'refused' counts, per required reference, the rows
+    that would make the delete fail.
+    """
+    with timed('bulk:preview_delete') as frame:
+        counts = _preview(table_name, filter_query, ids)
+    return _report(frame, **counts)
+
+
+def describe_preview(preview):
+    """Returns a preview_delete result as one line of text."""
+    refused = [f'{count} {name}'
+               for name, count in preview['refused'].items() if count]
+    if refused:
+        return ('The delete would fail, as these rows require the rows '
+                'deleted: ' + ', '.join(refused))
+    groups = []
+    for key, verb in (('deleted', 'delete'), ('nullified', 'clear'),
+                      ('unlinked', 'unlink')):
+        parts = [f'{count} {name}'
+                 for name, count in preview[key].items() if count]
+        if parts:
+            groups.append(f'{verb} {", ".join(parts)}')
+    return (('Would ' + '; '.join(groups) if groups else 'Nothing to delete')
+            + f' (counted in {preview["seconds"]:.3f}s)')
+
+
+def describe_report(report):
+    """Returns a bulk_set or bulk_delete result as one line of text."""
+    parts = []
+    if 'updated' in report:
+        parts.append(f'{report["updated"]} rows updated')
+    for key in ('deleted', 'nullified', 'unlinked'):
+        parts += [f'{count} {name} {key}'
+                  for name, count in report.get(key, {}).items() if count]
+    return (', '.join(parts or ['No rows changed']) +
+            f' in {report["seconds"]:.3f}s '
+            f'({report["statements"]} SQL statements)')
+
+
+def get_bulk_panel():
+    return html.Div([
+        html.H3('Bulk edit'),
+        Row([
+            Col(size=4, children=dcc.Input(
+                id='bulk-ids', style={'width': '100%'},
+                placeholder='ids, e.g. 1, 4-6 (default: rows of the '
+                            'grid filter)')),
+            Col(size=3, children=dcc.Dropdown(id='bulk-column',
+                                              placeholder='column')),
+            Col(size=3, children=dcc.Input(id='bulk-value',
+                                           placeholder='new value',
+                                           style={'width': '100%'})),
+        ]),
+        Button(id='bulk-set', children='Set on selected rows',
+               className='btn'),
+        Button(id='bulk-preview', children='Preview delete',
+               className='btn'),
+        dcc.ConfirmDialogProvider(
+            id='bulk-delete', message='Delete every selected row?',
+            children=Button(children='Delete selected rows',
+                            className='btn')),
+        html.Div(id='bulk-result'),
+    ])
+
+
+def assign_bulk_callbacks(app):
+
+    @app.callback(Output('bulk-column', 'options'),
+                  [Input('table-dropdown', 'value')])
+    def choose_bulk_table(table_name):
+        if not table_name:
+            return []
+        table = PonyTable(table_name)
+        return [{'label': column.name, 'value': column.name}
+                for column in grid_columns(table_name)
+                if column.kind is not table.ID]
+
+    @app.callback(Output('bulk-result', 'children'),
+                  [Input('bulk-set', 'n_clicks'),
+                   Input('bulk-preview', 'n_clicks'),
+                   Input('bulk-delete', 'submit_n_clicks')],
+                  [State('table-dropdown', 'value'),
+                   State('entry-grid', 'filter_query'),
+                   State('bulk-ids', 'value'),
+                   State('bulk-column', 'value'),
+                   State('bulk-value', 'value')])
+    @timed('callback:run_bulk')
+    def run_bulk(set_clicks, preview_clicks, delete_clicks, table_name,
+                 filter_query, ids_text, column_name, value):
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        if not table_name or not (set_clicks or preview_clicks or
+                                  delete_clicks):
+            return dash.no_update
+        try:
+            ids = parse_ids(ids_text) if ids_text else None
+            if 'bulk-preview.n_clicks' in triggered:
+                return describe_preview(
+                    preview_delete(table_name, filter_query, ids))
+            elif 'bulk-delete.submit_n_clicks' in triggered:
+                report = bulk_delete(table_name, filter_query, ids)
+            elif column_name:
+                report = bulk_set(table_name, column_name, value,
+                                  filter_query, ids)
+            else:
+                return 'Choose the column to set'
+        except ValueError as error:
+            return str(error)
+        except IntegrityError as error:
+            return f'Rejected by the database: {error}'
+        return describe_report(report)
+
+    return app
@@ -0,0 +1,185 @@
+import pickle
+import random
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+
+# entries kept by the default backend
+MEMORY_CACHE_SIZE = 10000
+
+
+class MemoryBackend:
+    """
+    Keeps values and entity versions in the memory of the process, with
+    the least recently used values dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries=MEMORY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._values = OrderedDict()
+        self._versions = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._values:
+                    self._values.move_to_end(key)
+                    found[key] = self._values[key]
+        return found
+
+    def set_many(self, items):
+        with self._lock:
+            self._values.update(items)
+            for key in items:
+                self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def versions(self, names):
+        with self._lock:
+            return {name: self._versions[name] for name in names}
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._versions[name] += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class SQLiteBackend:
+    """
+    Keeps pickled values and entity versions in an SQLite file, so that
+    every worker process using the same file shares them. Beyond
+    max_entries the oldest values are dropped.
+    """
+
+    # share of writes followed by a check for values to drop
+    PRUNE_PROBABILITY = 0.01
+
+    def __init__(self, path, max_entries=100000):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_values '
+                               '(key TEXT PRIMARY KEY, value BLOB)')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_versions '
+                               '(name TEXT PRIMARY KEY, version INTEGER)')
+
+    def _connection(self):
+        if not hasattr(self._local, 'connection'):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return self._local.connection
+
+    def _select(self, sql, values):
+        rows = []
+        values = list(values)
+        # stays below SQLite's limit on bound parameters
+        for start in range(0, len(values), 500):
+            batch = values[start:start + 500]
+            rows += self._connection().execute(
+                sql.format(', '.join('?' * len(batch))), batch).fetchall()
+        return rows
+
+    def get_many(self, keys):
+        rows = self._select('SELECT key, value FROM cache_values '
+                            'WHERE key IN ({})', keys)
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def set_many(self, items):
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO cache_values (key, value) '
+                'VALUES (?, ?)',
+                [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                 for key, value in items.items()])
+            if random.random() < self.PRUNE_PROBABILITY:
+                connection.execute(
+                    'DELETE FROM cache_values WHERE rowid <= '
+                    '(SELECT MAX(rowid) FROM cache_values) - ?',
+                    (self.max_entries,))
+
+    def versions(self, names):
+        found = dict(self._select('SELECT name, version FROM cache_versions '
+                                  'WHERE name IN ({})', names))
+        return {name: found.get(name, 0) for name in names}
+
+    def bump(self, names):
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT INTO cache_versions (name, version) VALUES (?, 1) '
+                'ON CONFLICT (name) DO UPDATE SET version = version + 1',
+                [(name,) for name in names])
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache_values')
+
+
+_backend = MemoryBackend()
+
+
+def configure(backend):
+    """Replaces the backend every cached value is kept in."""
+    global _backend
+    _backend = backend
+
+
+def bump(*names):
+    """
+    Marks the entities in names as changed, so that no value depending on
+    them is read from the cache again.
+    """
+    _backend.bump(names)
+
+
+def versions(*names):
+    return _backend.versions(names)
+
+
+def clear():
+    _backend.clear()
+
+
+def cached_many(kind, keys, depends_on, compute):
+    """
+    Returns a dict from each of keys to its value of the given kind.
+    depends_on names the entities the values are computed from, either as
+    a list or as a function of the key. Values are looked up under their
+    key and the current versions of those entities, and the missing ones
+    are computed at once by compute(missing_keys), which returns a dict.
+    """
+    if callable(depends_on):
+        dependencies = {key: sorted(depends_on(key)) for key in keys}
+    else:
+        dependencies = dict.fromkeys(keys, sorted(depends_on))
+    current = _backend.versions(
+        {name for names in dependencies.values() for name in names})
+    full_keys = {
+        key: f'{kind}:{key!r}:' + ','.join(f'{name}={current[name]}'
+                                           for name in names)
+        for key, names in dependencies.items()}
+    found = _backend.get_many(list(full_keys.values()))
+    values = {key: found[full_key] for key, full_key in full_keys.items()
+              if full_key in found}
+    missing = [key for key in keys if key not in values]
+    if missing:
+        computed = compute(missing)
+        _backend.set_many({full_keys[key]: value
+                           for key, value in computed.items()})
+        values.update(computed)
+    return values
+
+
+def cached(kind, key, depends_on, compute):
+    """Returns the single value compute() of cached_many."""
+    return cached_many(kind, [key], depends_on,
+                       lambda keys: {key: compute()})[key]
@@ -1,26 +1,215 @@
 import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 try:
-    from .db_loader import db  # , db_session, entities
+    from .db_loader import db, db_session, entities, argument_parser, \
+        use_definition, load_database
+    from .export import dependency_levels, deferred_references, \
+        link_collections, iter_rows, iter_links, iter_references, \
+        table_columns
+    from .load import insert_rows, add_links, set_references
 except ModuleNotFoundError:
-    from db_loader import db  # , db_session, entities
+    from db_loader import db, db_session, entities, argument_parser, \
+        use_definition, load_database
+    from export import dependency_levels, deferred_references, \
+        link_collections, iter_rows, iter_links, iter_references, \
+        table_columns
+    from load import insert_rows, add_links, set_references
 
+SUFFIX = '_'
 
-def copy():
+
+def copy_definition():
+    """
+    Writes the definition with every entity renamed to entity + SUFFIX next
+    to the original file and returns its path.
+    """
     db_file = Path(db.__file__)
 
     with open(db_file, 'r') as f:
         file_content = f.read()
 
-    for entity in db.entities:
-        file_content = re.sub(fr'\b{entity}\b', f'{entity}_', file_content)
+    # longest names first, so that no name is cut short by one of its prefixes
+    names = sorted(entities, key=len, reverse=True)
+    pattern = re.compile(r'\b(' + '|'.join(map(re.escape, names)) + r')\b')
+    file_content = pattern.sub(r'\g<1>' + SUFFIX, file_content)
 
-    import pdb
-    pdb.set_trace()
-    with open(str(db_file).replace('.py', '_.py'), 'w') as f:
+    new_file = db_file.with_name(db_file.stem + SUFFIX + db_file.suffix)
+    with open(new_file, 'w') as f:
         f.write(file_content)
+    return new_file
+
+
+def _report(name, total, start, report):
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {total} rows in {elapsed:.1f}s '
+          f'({total / elapsed if elapsed else 0:.0f} rows/s)', file=report)
+
+
+def _as_stored(target):
+    """
+    Tells whether rows can be copied into target as the source database
+    stores them, with raw executemany statements: between SQLite
+    databases, whose values need no conversion. Other providers go through
+    the entities.
+    """
+    return db._db.provider_name == 'sqlite' and \
+        target._database_.provider_name == 'sqlite'
+
+
+def _executemany(target, sql, rows):
+    """Runs sql for rows in one transaction of the database of target."""
+    database = target._database_
+    with db_session:
+        database.get_connection().executemany(sql, rows)
+        database.commit()
+
+
+def _insert_sql(target, table, columns):
+    quote = target._database_.provider.quote_name
+    return (f'INSERT INTO {quote(table)} '
+            f'({", ".join(quote(c) for c in columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})')
+
+
+def copy_table(entity, target, chunk_size, report, deferred=()):
+    """
+    Copies the rows of entity into target, leaving the references named in
+    deferred empty.
+    """
+    start = time.perf_counter()
+    names = [attr.name for attr in table_columns(entity)]
+    kept = [i for i, name in enumerate(names) if name not in deferred]
+    columns = [names[i] for i in kept]
+    as_stored = _as_stored(target)
+    sql = _insert_sql(target, target._table_,
+                      [getattr(target, name).column for name in columns])
+    total = 0
+    for chunk in iter_rows(entity, chunk_size, convert=not as_stored):
+        rows = [[row[i] for i in kept] for row in chunk]
+        if as_stored:
+            _executemany(target, sql, rows)
+        else:
+            with db_session:
+                insert_rows(target, columns, rows)
+        total += len(chunk)
+    _report(target.__name__, total, start, report)
+
+
+def copy_links(attr, target, chunk_size, report):
+    start = time.perf_counter()
+    target_attr = getattr(target, attr.name)
+    owner_columns = target_attr.reverse_columns if target_attr.symmetric \
+        else target_attr.reverse.columns
+    sql = _insert_sql(target, target_attr.table,
+                      [owner_columns[0], target_attr.columns[0]])
+    total = 0
+    for chunk in iter_links(attr, chunk_size):
+        if _as_stored(target):
+            _executemany(target, sql, [[owner_id, item_id]
+                                       for owner_id, ids in chunk
+                                       for item_id in ids])
+        else:
+            with db_session:
+                add_links(target, attr.name, chunk)
+        total += sum(len(ids) for _, ids in chunk)
+    _report(f'{target.__name__}.{attr.name}', total, start, report)
+
+
+def copy_references(attr, target, chunk_size, report):
+    start = time.perf_counter()
+    quote = target._database_.provider.quote_name
+    sql = (f'UPDATE {quote(target._table_)} '
+           f'SET {quote(getattr(target, attr.name).column)} = ? '
+           f'WHERE {quote(target._pk_columns_[0])} = ?')
+    total = 0
+    for chunk in iter_references(attr, chunk_size):
+        if _as_stored(target):
+            _executemany(target, sql, [[item_id, owner_id]
+                                       for owner_id, item_id in chunk])
+        else:
+            with db_session:
+                set_references(target, attr.name, chunk)
+        total += len(chunk)
+    _report(f'{target.__name__}.{attr.name}', total, start, report)
+
+
+def _in_memory(database):
+    """
+    Tells whether database is an SQLite database in memory, which pony
+    connects to anew on every thread.
+    """
+    pool = database.provider.pool
+    return database.provider_name == 'sqlite' and (
+        pool.is_shared_memory_db or pool.filename == ':memory:')
+
+
+def _run(pool, calls):
+    """
+    Runs the (function, *args) calls concurrently on pool, or one after
+    the other on the calling thread if pool is None, and waits for them.
+    """
+    if pool is None:
+        for function, *args in calls:
+            function(*args)
+        return
+    for future in [pool.submit(*call) for call in calls]:
+        future.result()
+
+
+def copy(copy_data=True, workers=4, chunk_size=1000, report=sys.stderr):
+    """
+    Writes the suffixed definition and copies every row into its entities.
+    Tables are copied in dependency order, with the tables that do not
+    depend on each other copied concurrently by a pool of workers, followed
+    by the many-to-many links. Between SQLite databases the rows are
+    copied as stored, one executemany per chunk, and through the entities
+    otherwise. The references closing a reference cycle
+    (see deferred_references) are copied last, once every row exists.
+    Databases in memory are copied on the calling thread, as the workers
+    would each connect to an empty database of their own.
+    """
+    new_file = copy_definition()
+    if not copy_data:
+        return new_file
+    new_db, _, new_entities = load_database(str(new_file))
+    deferred = deferred_references()
+    pool = None
+    if not (_in_memory(db._db) or _in_memory(new_db._db)):
+        pool = ThreadPoolExecutor(workers)
+    try:
+        for level in dependency_levels():
+            _run(pool, [(copy_table, entity, new_entities[entity + SUFFIX],
+                         chunk_size, report,
+                         {attr.name for attr in deferred
+                          if attr.entity.__name__ == entity})
+                        for entity in level])
+        _run(pool, [(copy_links, attr,
+                     new_entities[attr.entity.__name__ + SUFFIX],
+                     chunk_size, report)
+                    for attr in link_collections()])
+        _run(pool, [(copy_references, attr,
+                     new_entities[attr.entity.__name__ + SUFFIX],
+                     chunk_size, report)
+                    for attr in deferred])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return new_file
 
 
 if __name__ == '__main__':
-    copy()
+    parser = argument_parser('Copies the database definition with suffixed '
+                             'entity names, and its rows into them')
+    parser.add_argument('--schema-only', action='store_true',
+                        help='only write the suffixed definition')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='tables copied concurrently')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='rows copied per transaction')
+    args = parser.parse_args()
+    use_definition(args.definition)
+    copy(not args.schema_only, args.workers, args.chunk_size)
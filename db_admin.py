@@ -1,26 +1,46 @@
-import datetime as dtt
-import decimal
+import logging
+import re
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ALL, MATCH
 
 from mydash.component import Row, Col, Button
 
 try:
-    from .db_loader import db, db_session, entities
+    from .db_loader import db, entities, argument_parser, use_definition, \
+        sqlite_profile
+    from . import cache, metrics
+    from .metrics import session, read_session, timed
+    from .grid import get_grid, assign_grid_callbacks
+    from .bulk import get_bulk_panel, assign_bulk_callbacks, \
+        preview_delete, describe_preview
+    from . import search
+    from .pony_table import PonyTable, CollectionPage, entry_option, \
+        get_table_and_id_from_repr, get_table_counts, get_labels, \
+        label_dependencies, enable_label_table
 except ModuleNotFoundError:
-    from db_loader import db, db_session, entities
+    from db_loader import db, entities, argument_parser, use_definition, \
+        sqlite_profile
+    import cache
+    import metrics
+    from metrics import session, read_session, timed
+    from grid import get_grid, assign_grid_callbacks
+    from bulk import get_bulk_panel, assign_bulk_callbacks, \
+        preview_delete, describe_preview
+    import search
+    from pony_table import PonyTable, CollectionPage, entry_option, \
+        get_table_and_id_from_repr, get_table_counts, get_labels, \
+        label_dependencies, enable_label_table
+
+logger = logging.getLogger(__name__)
 
 
-@db_session
 def get_table_summary():
-    tables = {}
+    tables = get_table_counts()
     name_size = 6
     el_size = 3
-    for table in entities:
-        tables[table] = entities[table].select().count()
     header = [Row([Col(html.H3('Table Name'), size=name_size),
                    Col(html.H3('Elements'), size=el_size)])]
     tables = [Row([Col(key, size=name_size), Col(tables[key], size=el_size)])
@@ -33,167 +53,30 @@ class MyButtons:
     types = ['add', 'modify', 'delete']
     names = ['Add New', 'Modify', 'Delete']
 
-    def __init__(self, table_name):
-        self.field_ids = [f'{t}-button-{table_name}' for t in self.types]
-        self.table_name = table_name
+    def __init__(self):
+        self.field_ids = [{'type': 'entry-button', 'action': t}
+                          for t in self.types]
 
     def get_buttons(self):
         return [Button(id=id_, children=name, className='btn',
                        n_clicks_timestamp=0)
                 for id_, name in zip(self.field_ids, self.names)]
 
-    def get_inputs(self):
-        return [Input(component_id, 'n_clicks_timestamp')
-                for component_id in self.field_ids]
-
-
-@db_session
-def label(val, use_label=True):
-    if use_label and hasattr(val, 'label'):
-        return val.label()
-    elif isinstance(val, dtt.datetime):
-        date_str = val.strftime('%Y-%m-%d')
-        no_hour_min = val.hour == val.minute == 0
-        time_str = '' if no_hour_min else ' ' + val.strftime('%H:%M')
-        return date_str + time_str
-    elif isinstance(val, str):
-        return val
-    elif val is not None:
-        return repr(val)
-
-
-def get_table_and_id_from_repr(entry_repr):
-    if '[' in entry_repr:
-        start_bracket = entry_repr.index('[')
-        end_bracket = entry_repr.index(']')
-        table_name = entry_repr[1:start_bracket]
-        id_ = int(entry_repr[start_bracket+1:end_bracket])
-        return table_name, id_
-
-
-@db_session
-def get_entry_from_repr(entry_repr):
-    table_name_id = get_table_and_id_from_repr(entry_repr)
-    if table_name_id:
-        return entities[table_name_id[0]][table_name_id[1]]
-
-
-class PonyTable:
-
-    ID = 0
-    SET = 1
-    REFERENCE = 2
-    DATE = 3
-    STR = 4
-    BOOL = 5
-    DECIMAL = 6
-
-    def __init__(self, table_name):
-        self.table_name = table_name
-
-    @property
-    @db_session
-    def table(self):
-        return entities[self.table_name]
-
-    @property
-    @db_session
-    def table_cols(self):
-        return [a.name for a in self.table._attrs_]
-
-    @db_session
-    def _unpack_args(self, args):
-        output = {}
-        for col, arg in zip(self.table_cols, args):
-            col_type = self._get_type(col)
-            if col_type is self.SET:
-                arg = [get_entry_from_repr(e) for e in arg]
-            elif col_type is self.REFERENCE:
-                print(arg, type(arg))
-                arg = get_entry_from_repr(arg)
-            elif col_type is self.DATE:
-                print(arg)
-            elif col_type is self.BOOL:
-                arg = len(arg) > 0
-                print(arg)
-            output[col] = arg
-        return output
+    @staticmethod
+    def get_inputs():
+        return [Input({'type': 'entry-button', 'action': ALL},
+                      'n_clicks_timestamp')]
 
-    def _get_type(self, key):
-        attr = self.get_attribute(key)
-        attr_type = attr.py_type
-        if isinstance(attr, db.Set):
-            return self.SET
-        elif attr_type in entities.values():
-            return self.REFERENCE
-        elif attr_type is dtt.datetime:
-            return self.DATE
-        elif attr_type is str:
-            return self.STR
-        elif attr_type is bool:
-            return self.BOOL
-        elif attr_type is decimal.Decimal:
-            return self.DECIMAL
-        elif key == 'id':
-            return self.ID
-        else:
-            raise ValueError(f'Unknown type for {self.table_name}: {key} - '
-                             f'({attr}, {attr_type})')
-
-    def none_val(self, key):
-        attr_type = self._get_type(key)
-        if attr_type == self.SET:
-            return []
-        elif attr_type == self.REFERENCE:
-            return None
-        elif attr_type == self.DATE:
-            return None
-        elif attr_type == self.STR:
-            return ''
-        elif attr_type == self.BOOL:
-            raise ValueError('BOOL type cannot have a None equivalent')
-        elif attr_type == self.DECIMAL:
-            raise ValueError('DECIMAL type cannot have a None equivalent')
-        elif key == 'id':
-            raise ValueError('ID type cannot have a None equivalent')
-
-    @db_session
-    def get_entry(self, id_):
-        return self.table[id_].to_dict(related_objects=True,
-                                       with_collections=True)
-
-    @db_session
-    def get_attribute(self, key):
-        return getattr(self.table, key)
-
-    def is_unique(self, key):
-        return self.get_attribute(key).is_unique
-
-    def is_required(self, key):
-        return self.get_attribute(key).is_required
-
-    @db_session
-    def add_entry(self, args):
-        e_dict = self._unpack_args(args)
-        if 'id' in e_dict:
-            e_dict.pop('id')
-        entities[self.table_name](**e_dict)
-
-    @db_session
-    def modify_entry(self, args):
-        e_dict = self._unpack_args(args)
-        current_entry = entities[self.table_name][e_dict['id']]
-        for key in self.table_cols:
-            print(current_entry, key,
-                  e_dict[key] if key in e_dict else self.none_val(key))
-            setattr(current_entry, key,
-                    e_dict[key] if key in e_dict else self.none_val(key))
-
-    @db_session
-    def delete_entry(self, args):
-        e_dict = self._unpack_args(args)
-        if e_dict['id']:
-            entities[self.table_name][e_dict['id']].delete()
+
+def _field_id_type(kind):
+    """
+    Returns the id type of the form fields of kind. Dropdowns get one of
+    their own, so that the callback searching their options only matches
+    components having a search_value.
+    """
+    if kind in (PonyTable.SET, PonyTable.REFERENCE):
+        return 'entry-field-dropdown'
+    return f'entry-field-{PonyTable.COMPONENT_PROPERTY[kind]}'
 
 
 class EntryForm:
@@ -204,39 +87,35 @@ class EntryForm:
 
     col_size = 2
 
+    # one pattern per id type and component property, so that a single
+    # callback can read the fields of whichever form is displayed
+    state_list = [State({'type': type_, 'column': ALL}, prop)
+                  for type_, prop in sorted(set(
+                      (_field_id_type(kind), prop) for kind, prop in
+                      PonyTable.COMPONENT_PROPERTY.items()))]
+
     def __init__(self, table_name=None):
         self.table = PonyTable(table_name)
-
-        self._dummy_output_id = f'dummy-output-{table_name}'
-        self.state_list = [
-            State(*a) for a in self._get_component_id_property()]
         self.form_id = f'{self.table.table_name}-database-entry'
 
     def _get_field_entry_id(self, key):
-        return f'formid-{self.table.table_name}-{key}'
-
-    def _get_component_id_property(self):
-        s = []
-        for key in self.table.table_cols:
-            field_type = self.table._get_type(key)
-            component_id = self._get_field_entry_id(key)
-            if field_type == self.table.ID:
-                component_property = 'children'
+        return {'type': _field_id_type(self.table.columns[key].kind),
+                'column': key}
 
-            elif field_type == self.table.DATE:
-                component_property = 'date'
-
-            elif field_type in [self.table.STR, self.table.DECIMAL,
-                                self.table.REFERENCE, self.table.SET]:
-                component_property = 'value'
-
-            elif field_type == self.table.BOOL:
-                component_property = 'values'
-            s.append((component_id, component_property))
-        return s
+    @staticmethod
+    def _get_value_options(target, reprs):
+        """
+        Returns the dropdown options of the entries of target among reprs,
+        so that a form lists only its current values until searched.
+        """
+        ids = [get_table_and_id_from_repr(repr_)[1] for repr_ in reprs]
+        labels = get_labels(target, ids)
+        return [{'label': labels[id_][0], 'value': labels[id_][1]}
+                for id_ in ids if id_ in labels]
 
     def _get_component_for(self, key, val):
-        field_type = self.table._get_type(key)
+        column = self.table.columns[key]
+        field_type = column.kind
         value = self._get_value_for(key, val)
 
         if field_type == self.table.ID:
@@ -244,20 +123,17 @@ class EntryForm:
                                  children=value)
 
         elif field_type == self.table.SET:
-            attr = self.table.get_attribute(key)
-            attr_type = attr.py_type
-            options = [{'label': entry.label(), 'value': repr(entry)} for
-                       entry in attr_type.select().fetch()]
+            options = self._get_value_options(column.target, val or [])
+            if isinstance(val, CollectionPage) and val.is_partial:
+                options = options + [val.rest_option()]
             component = dcc.Dropdown(id=self._get_field_entry_id(key),
                                      options=options,
                                      value=value,
                                      multi=True)
 
         elif field_type == self.table.REFERENCE:
-            attr = self.table.get_attribute(key)
-            attr_type = attr.py_type
-            options = [{'label': entry.label(), 'value': repr(entry)} for entry
-                       in attr_type.select().fetch()]
+            options = self._get_value_options(column.target,
+                                              [val] if val else [])
             component = dcc.Dropdown(id=self._get_field_entry_id(key),
                                      options=options, value=value)
 
@@ -294,11 +170,16 @@ class EntryForm:
         if field_type in [self.table.ID, self.table.DATE]:
             return val
         if field_type in [self.table.STR, self.table.DECIMAL]:
-            return val if val else ''
+            return '' if val is None else val
         elif field_type == self.table.SET:
-            return None if val is None else [repr(v) for v in val]
+            if val is None:
+                return None
+            value = list(val)
+            if isinstance(val, CollectionPage) and val.is_partial:
+                value.append(val.rest_option()['value'])
+            return value
         elif field_type == self.table.REFERENCE:
-            return repr(val)
+            return repr(None) if val is None else val
         elif field_type == self.table.BOOL:
             return [key] if val else []
 
@@ -309,7 +190,7 @@ class EntryForm:
     def get_form(self, id_=None):
         return html.Div(self.get_form_children(id_), id=self.form_id)
 
-    @db_session
+    @read_session
     def get_form_children(self, id_=None):
         """
         Takes in a table name and an id and produces a form to fill out
@@ -318,7 +199,7 @@ class EntryForm:
         e_dict = {} if id_ is None else self.table.get_entry(id_)
         children = [self._get_header()]
         bkg_toggle = 0
-        for key in self.table.table_cols:
+        for key, column in self.table.columns.items():
             val = e_dict.get(key)
             component = self._get_component_for(key, val)
             if bkg_toggle:
@@ -326,90 +207,230 @@ class EntryForm:
             else:
                 bkg = self.GREY
             bkg_toggle = 1 - bkg_toggle
-            star = '*' if self.table.is_unique(key) else ''
-            hat = '^' if self.table.is_required(key) else ''
+            star = '*' if column.is_unique else ''
+            hat = '^' if column.is_required else ''
             child = Row([Col(key + star + hat, size=self.col_size),
                          Col(component)], style=bkg)
             children.append(child)
         return children
 
-    def get_dummy_output(self):
-        return html.Div(id=self._dummy_output_id, hidden=True)
+
+_entry_forms = {}
+
+
+def get_entry_form(table_name):
+    """
+    Returns the EntryForm of table_name, building it (and compiling the
+    table's columns) the first time it is needed.
+    """
+    if table_name not in _entry_forms:
+        _entry_forms[table_name] = EntryForm(table_name)
+    return _entry_forms[table_name]
 
 
-@db_session
 def initialise():
-    entry_forms = {table_name: EntryForm(table_name)
-                   for table_name in entities}
-    dummy_outputs = [ef.get_dummy_output() for ef in entry_forms.values()]
+    dummy_output = html.Div(id='dummy-output', hidden=True)
     _options = [{'label': table_name, 'value': table_name}
                 for table_name in entities]
     table_dropdown = dcc.Dropdown(id='table-dropdown', options=_options)
     inspect_entry = Col(size=12, id='inspect-entry')
     entry_dropdown = dcc.Dropdown(id='entry-dropdown')
-    return (entry_forms, dummy_outputs, table_dropdown, entry_dropdown,
-            inspect_entry)
-
-
-(entry_forms, dummy_outputs, table_dropdown, entry_dropdown,
- inspect_entry) = initialise()
-
-
-@db_session
-def _get_entry_dropdown_options(table_name):
-    if table_name:
-        entries = entities[table_name].select()
-        options = [{'label': entry.label(), 'value': repr(entry)}
-                   for entry in entries]
-    else:
-        options = []
-    return options
-
-
-layout = Row([
-            Col(size=4, children=get_table_summary()),
+    return dummy_output, table_dropdown, entry_dropdown, inspect_entry
+
+
+ENTRY_PAGE_SIZE = 50
+# how often the page asks for entities changed by other sessions
+VERSION_POLL_SECONDS = 5
+
+
+@read_session
+def _get_entry_dropdown_options(table_name, search=None, after=None,
+                                limit=ENTRY_PAGE_SIZE):
+    """
+    Returns at most limit options for table_name ordered by id.
+
+    Only the rows of the requested page are fetched. search restricts the
+    page to entries whose id or text columns match it and after continues
+    the listing from the given id (keyset pagination).
+    """
+    if not table_name:
+        return []
+    entity = entities[table_name]
+    table = PonyTable(table_name)
+    quote = db._db.provider.quote_name
+    id_col = quote(entity._pk_columns_[0])
+    params = {'after': after, 'limit': limit}
+    conditions = []
+    if after is not None:
+        conditions.append(f'{id_col} > $after')
+    if search:
+        params['pattern'] = '%' + re.sub(r'([%_\\])', r'\\\1', search) + '%'
+        matches = [f"{quote(table.get_attribute(column.name).column)} "
+                   "LIKE $pattern ESCAPE '\\'"
+                   for column in table.columns.values()
+                   if column.kind == table.STR]
+        if search.strip().isdigit():
+            params['search_id'] = int(search)
+            matches.append(f'{id_col} = $search_id')
+        conditions.append('(' + (' OR '.join(matches) or '0 = 1') + ')')
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    sql = (f'SELECT {id_col} FROM {quote(entity._table_)}{where} '
+           f'ORDER BY {id_col} LIMIT $limit')
+    ids = db._db.select(sql, params)
+    labels = get_labels(table_name, ids)
+    return [{'label': labels[id_][0], 'value': labels[id_][1]}
+            for id_ in ids if id_ in labels]
+
+
+@read_session
+def _get_selected_option(table_name, id_):
+    """
+    Returns the dropdown option of the entry id_ of table_name, or None if
+    it was deleted meanwhile, e.g. by another session.
+    """
+    entry = entities[table_name].get(id=id_)
+    return entry_option(entry) if entry is not None else None
+
+
+def get_layout():
+    dummy_output, table_dropdown, entry_dropdown, inspect_entry = initialise()
+    return Row([
+            Col(size=4, id='table-summary', children=get_table_summary()),
             Col(size=8, children=[
+                dcc.Dropdown(id='global-search',
+                             placeholder='Search every table'),
                 table_dropdown,
                 entry_dropdown,
-                html.Div(id='entry-content')
-            ] + dummy_outputs
-            )
+                Button(id='entry-dropdown-more', children='Load more',
+                       className='btn'),
+                html.Div(id='entry-content'),
+                dummy_output,
+                dcc.Store(id='entity-versions'),
+                dcc.Store(id='entry-options-version'),
+                dcc.Interval(id='version-poll',
+                             interval=VERSION_POLL_SECONDS * 1000)
+            ]),
+            Col(size=12, children=[get_grid(), get_bulk_panel()])
         ])
 
 
-@db_session
-def modify_entry(add_timestamp, modify_timestamp, remove_timestamp, table_name,
-                 output, *args):
-    print('modify_entry')
-    if table_name:
-        output = output + 1 if output else 1
-        t = PonyTable(table_name)
-        if add_timestamp > max(modify_timestamp, remove_timestamp):
-            print('Add', modify_timestamp)
-            t.add_entry(args)
-        elif modify_timestamp > max(add_timestamp, remove_timestamp):
-            print('Modify', modify_timestamp)
-            t.modify_entry(args)
-        elif remove_timestamp > max(add_timestamp, modify_timestamp):
-            print('Remove', remove_timestamp)
-            t.delete_entry(args)
+@session
+def modify_entry(timestamps, table_name, output, *field_values):
+    """
+    Adds, modifies or deletes an entry of table_name depending on the most
+    recently clicked button, using the fields of the displayed form.
+    """
+    logger.debug('modify_entry')
+    ctx = dash.callback_context
+    clicked = {button['id']['action']: button.get('value') or 0
+               for button in ctx.inputs_list[0]}
+    if not table_name or not any(clicked.values()):
+        return output
+    fields = {state['id']['column']: state.get('value')
+              for states in ctx.states_list[2:] for state in states}
+    t = PonyTable(table_name)
+    args = [fields.get(key) for key in t.table_cols]
+    output = output + 1 if output else 1
+    action = max(clicked, key=clicked.get)
+    logger.debug('%s %s', action.capitalize(), clicked[action])
+    if action == 'add':
+        t.add_entry(args)
+    elif action == 'modify':
+        t.modify_entry(args)
+    elif action == 'delete':
+        t.delete_entry(args)
     return output
 
 
 def assign_callbacks(app):
 
-    @app.callback(Output(entry_dropdown.id, 'options'),
-                  [Input(table_dropdown.id, 'value')] +
-                  [Input(d.id, 'children') for d in dummy_outputs])
-    def choose_table(table_name, *args):
-        print('choose_table')
-        return _get_entry_dropdown_options(table_name) if table_name else []
-
-    @app.callback(Output(entry_dropdown.id, 'value'),
-                  [Input(table_dropdown.id, 'value')],
-                  [State(entry_dropdown.id, 'value')])
-    def reset_entry_value(new_table_name, current_entry_repr):
-        print('reset_entry_value', new_table_name, current_entry_repr)
+    @app.callback(Output('entity-versions', 'data'),
+                  [Input('dummy-output', 'children'),
+                   Input('bulk-result', 'children'),
+                   Input('version-poll', 'n_intervals')],
+                  [State('entity-versions', 'data')])
+    @timed('callback:update_versions')
+    def update_versions(change_count, bulk_result, n_intervals,
+                        current_versions):
+        versions = cache.versions(*entities)
+        if versions == current_versions:
+            return dash.no_update
+        return versions
+
+    @app.callback([Output('entry-dropdown', 'options'),
+                   Output('entry-options-version', 'data')],
+                  [Input('table-dropdown', 'value'),
+                   Input('entry-dropdown', 'search_value'),
+                   Input('entry-dropdown-more', 'n_clicks'),
+                   Input('entity-versions', 'data')],
+                  [State('entry-dropdown', 'value'),
+                   State('entry-dropdown', 'options'),
+                   State('global-search', 'value'),
+                   State('entry-options-version', 'data')])
+    @timed('callback:choose_table')
+    def choose_table(table_name, search_value, n_clicks, versions,
+                     entry_repr, options, found_repr, options_version):
+        """
+        Fills the entry dropdown with the options of table_name. A change
+        of entity versions only refetches them if the version of table_name
+        or of an entity its labels depend on moved since they were read.
+        """
+        if not table_name:
+            return [], None
+        version = [table_name, [(versions or {}).get(name) for name in
+                                sorted(label_dependencies(table_name))]]
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        if triggered == ['entity-versions.data'] and \
+                version == options_version:
+            return dash.no_update, dash.no_update
+        if 'entry-dropdown-more.n_clicks' in triggered and options:
+            last = get_table_and_id_from_repr(options[-1]['value'])
+            return options + _get_entry_dropdown_options(
+                table_name, search_value, after=last[1]), version
+        options = _get_entry_dropdown_options(table_name, search_value)
+        for selected_repr in [found_repr, entry_repr]:
+            selected = (get_table_and_id_from_repr(selected_repr)
+                        if selected_repr else None)
+            if (selected and selected[0] == table_name and
+                    selected_repr not in [o['value'] for o in options]):
+                option = _get_selected_option(*selected)
+                if option is not None:
+                    options.insert(0, option)
+        return options, version
+
+    @app.callback(Output('global-search', 'options'),
+                  [Input('global-search', 'search_value')])
+    @timed('callback:search_entries')
+    def search_entries(query):
+        if not query:
+            # keeps the option of the selected result
+            return dash.no_update
+        return search.search_options(query)
+
+    @app.callback(Output('table-dropdown', 'value'),
+                  [Input('global-search', 'value')])
+    def choose_search_result(found_repr):
+        if not found_repr:
+            return dash.no_update
+        return get_table_and_id_from_repr(found_repr)[0]
+
+    @app.callback(Output('table-summary', 'children'),
+                  [Input('entity-versions', 'data')])
+    @timed('callback:refresh_table_summary')
+    def refresh_table_summary(versions):
+        return get_table_summary()
+
+    @app.callback(Output('entry-dropdown', 'value'),
+                  [Input('table-dropdown', 'value'),
+                   Input('global-search', 'value')],
+                  [State('entry-dropdown', 'value')])
+    @timed('callback:reset_entry_value')
+    def reset_entry_value(new_table_name, found_repr, current_entry_repr):
+        logger.debug('reset_entry_value %s %s', new_table_name,
+                     current_entry_repr)
+        triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+        if found_repr and 'global-search.value' in triggered:
+            return found_repr
         if current_entry_repr:
             table_name, id_ = get_table_and_id_from_repr(current_entry_repr)
             if table_name == new_table_name:
@@ -417,28 +438,107 @@ def assign_callbacks(app):
         return None
 
     @app.callback(Output('entry-content', 'children'),
-                  [Input(entry_dropdown.id, 'value'),
-                  Input(table_dropdown.id, 'value')])
+                  [Input('entry-dropdown', 'value'),
+                  Input('table-dropdown', 'value')])
+    @timed('callback:choose_entry')
     def choose_entry(entry_repr, table_name):
-        print('choose_entry', entry_repr, table_name)
+        logger.debug('choose_entry %s %s', entry_repr, table_name)
         id_ = get_table_and_id_from_repr(entry_repr)[1] if entry_repr else None
         if table_name:
-            ef = entry_forms[table_name]
-            form = ef.get_form(id_)
-            buttons = MyButtons(table_name).get_buttons()
-            return html.Div([form] + buttons)
-
-    for table_name, ef in entry_forms.items():
-        app.callback(Output(f'dummy-output-{table_name}', 'children'),
-                     MyButtons(table_name).get_inputs(),
-                     [State('table-dropdown', 'value'),
-                      State(f'dummy-output-{table_name}', 'children')]
-                     + ef.state_list)(modify_entry)
-
+            form = get_entry_form(table_name).get_form(id_)
+            buttons = MyButtons().get_buttons()
+            preview = [Button(id='entry-delete-preview',
+                              children='Preview delete', className='btn'),
+                       html.Div(id='entry-delete-preview-result')]
+            return html.Div([form] + buttons + preview)
+
+    @app.callback(Output({'type': 'entry-field-dropdown', 'column': MATCH},
+                         'options'),
+                  [Input({'type': 'entry-field-dropdown', 'column': MATCH},
+                         'search_value')],
+                  [State({'type': 'entry-field-dropdown', 'column': MATCH},
+                         'value'),
+                   State({'type': 'entry-field-dropdown', 'column': MATCH},
+                         'options'),
+                   State('table-dropdown', 'value')],
+                  prevent_initial_call=True)
+    @timed('callback:search_field_options')
+    def search_field_options(search_value, value, options, table_name):
+        """
+        Fills a reference or collection dropdown of the entry form with a
+        page of the entries of its target matching search_value, keeping
+        the options of the selected values.
+        """
+        if not search_value or not table_name:
+            return dash.no_update
+        key = dash.callback_context.outputs_list['id']['column']
+        target = get_entry_form(table_name).table.columns[key].target
+        selected = value if isinstance(value, list) else [value]
+        options = [o for o in options or [] if o['value'] in selected]
+        kept = {o['value'] for o in options}
+        return options + [o for o in _get_entry_dropdown_options(
+            target, search_value) if o['value'] not in kept]
+
+    @app.callback(Output('entry-delete-preview-result', 'children'),
+                  [Input('entry-delete-preview', 'n_clicks')],
+                  [State('entry-dropdown', 'value')])
+    @timed('callback:preview_entry_delete')
+    def preview_entry_delete(n_clicks, entry_repr):
+        if not n_clicks or not entry_repr:
+            return None
+        table_name, id_ = get_table_and_id_from_repr(entry_repr)
+        return describe_preview(preview_delete(table_name, ids=[id_]))
+
+    app.callback(Output('dummy-output', 'children'),
+                 MyButtons.get_inputs(),
+                 [State('table-dropdown', 'value'),
+                  State('dummy-output', 'children')]
+                 + EntryForm.state_list)(
+        timed('callback:modify_entry')(modify_entry))
+
+    assign_grid_callbacks(app)
+    assign_bulk_callbacks(app)
     return app
 
 
 if __name__ == '__main__':
+    parser = argument_parser('Serves an admin page for a database')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='DEBUG, INFO, WARNING, ... (default: WARNING)')
+    parser.add_argument('--slow-callback-ms', type=float,
+                        help='log callbacks and sessions slower than this')
+    parser.add_argument('--cache-file',
+                        help='SQLite file caching table summaries, options, '
+                             'entries and labels for every worker sharing '
+                             'it (default: a cache per process)')
+    parser.add_argument('--label-table', action='store_true',
+                        help='materialize entry labels in a table of the '
+                             'database, filled at startup (default: labels '
+                             'are only cached in memory)')
+    parser.add_argument('--sqlite-profile', action='store_true',
+                        help='open SQLite connections in WAL mode with a '
+                             'larger page cache and memory mapping, so that '
+                             'reads are not blocked by writes')
+    parser.add_argument('--sqlite-pragma', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='PRAGMA overriding one of the profile, e.g. '
+                             'synchronous=FULL (implies --sqlite-profile)')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    if args.slow_callback_ms is not None:
+        metrics.slow_threshold = args.slow_callback_ms / 1000
+    if args.cache_file:
+        cache.configure(cache.SQLiteBackend(args.cache_file))
+    use_definition(args.definition)
+    if args.sqlite_profile or args.sqlite_pragma:
+        pragmas = dict(pragma.split('=', 1) for pragma in args.sqlite_pragma)
+        logger.info('SQLite profile: %s', sqlite_profile(**pragmas))
+    metrics.instrument_database(db._db)
+    if args.label_table:
+        enable_label_table()
+    if db._db.provider.dialect == 'SQLite':
+        search.ensure_index()
+
     app = dash.Dash(__name__)
     app.css.append_css({
         'external_url': ('https://stackpath.bootstrapcdn.com/'
@@ -456,11 +556,12 @@ if __name__ == '__main__':
                   [Input('url', 'pathname')])
     def route(pathname):
         if pathname == '/':
-            return layout
+            return get_layout()
         else:
             return 'Σφάλμα: 404'
 
     app.config.supress_callback_exceptions = True
 
     app = assign_callbacks(app)
+    metrics.register_endpoint(app.server)
     app.run_server(debug=True)
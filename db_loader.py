@@ -1,25 +1,123 @@
 import sys
+import argparse
 import importlib.util
+from collections.abc import Mapping
 from pathlib import Path
 
+from pony.orm import db_session
 
-def _import_database():
-    if len(sys.argv) < 2:
-        raise ValueError(
-            'Need Database definition as well, typical use:',
-            'python -m pony_utils.<FUNCTION> db_definition.py')
-    db_file = sys.argv[1]
+__all__ = ['argument_parser', 'use_definition', 'load_database', 'db',
+           'db_session', 'entities', 'SQLITE_PROFILE', 'sqlite_profile']
+
+_loaded = None
+_modules = {}
+
+
+def argument_parser(description):
+    """Returns a parser for the command line of a pony_utils tool."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('definition',
+                        help='python module defining the pony database')
+    return parser
+
+
+def use_definition(db_file):
+    """
+    Imports the definition module straight away, outside of any
+    db_session, and pins it as the one returned by load_database() until
+    the next call.
+    """
+    global _loaded
+    _loaded = load_database(db_file)
+    return _loaded
+
+
+def load_database(db_file=None):
+    """
+    Imports the database definition module and returns (db, db_session,
+    entities). Without db_file, returns the module pinned by
+    use_definition, or else pins the first command line argument, without
+    touching the file again. An explicit db_file is cached by path and
+    modification time, so a definition is only imported once per change.
+    As generating the mapping needs its own transaction, the first load
+    must not happen inside a db_session.
+    """
+    global _loaded
+    if db_file is None:
+        if _loaded is None:
+            if len(sys.argv) < 2:
+                raise ValueError(
+                    'Need Database definition as well, typical use:',
+                    'python -m pony_utils.<FUNCTION> db_definition.py')
+            _loaded = load_database(sys.argv[1])
+        return _loaded
     pnfn = Path(db_file).absolute()
-    file_path = str(pnfn)
-    module_name = pnfn.name
-    if '.py' == module_name[-3:]:
-        module_name = module_name[:-3]
-    spec = importlib.util.spec_from_file_location(module_name, file_path)
-    db = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(db)
-    db_session = db.db_session
-    entities = db._db.entities
-    return db, db_session, entities
-
-
-db, db_session, entities = _import_database()
+    key = (str(pnfn), pnfn.stat().st_mtime_ns)
+    if key not in _modules:
+        module_name = pnfn.name
+        if '.py' == module_name[-3:]:
+            module_name = module_name[:-3]
+        spec = importlib.util.spec_from_file_location(module_name, key[0])
+        db = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(db)
+        _modules[key] = db, db.db_session, db._db.entities
+    return _modules[key]
+
+
+class _LazyDatabase:
+    """Stands in for the definition module until it is first used."""
+
+    def __getattr__(self, name):
+        return getattr(load_database()[0], name)
+
+
+class _LazyEntities(Mapping):
+    """Stands in for the entities of the definition until first used."""
+
+    def __getitem__(self, key):
+        return load_database()[2][key]
+
+    def __iter__(self):
+        return iter(load_database()[2])
+
+    def __len__(self):
+        return len(load_database()[2])
+
+
+db = _LazyDatabase()
+entities = _LazyEntities()
+
+
+# PRAGMAs applied by sqlite_profile unless given other values
+SQLITE_PROFILE = {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                  'cache_size': -65536, 'mmap_size': 268435456}
+
+
+def sqlite_profile(**pragmas):
+    """
+    Applies SQLITE_PROFILE, updated with pragmas, to every connection of
+    the loaded database and returns the PRAGMAs applied. In WAL mode
+    readers carry on while a writer commits, so read callbacks served by
+    other threads are not blocked by writes. Does nothing for in-memory
+    databases and other providers. Must be called outside of db_session.
+    """
+    database = load_database()[0]._db
+    if database.provider_name != 'sqlite':
+        return {}
+    pool = database.provider.pool
+    if pool.is_shared_memory_db or pool.filename == ':memory:':
+        return {}
+    settings = dict(SQLITE_PROFILE, **pragmas)
+    for name, value in settings.items():
+        if not name.isidentifier() or not str(value).lstrip('-').isalnum():
+            raise ValueError(f'Invalid PRAGMA {name} = {value}')
+
+    def apply_profile(database, connection):
+        for name, value in settings.items():
+            connection.execute(f'PRAGMA {name} = {value}')
+
+    database.on_connect(provider='sqlite')(apply_profile)
+    # the connection already opened by this thread gets the profile when
+    # it is next opened
+    database.disconnect()
+    return settings
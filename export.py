@@ -0,0 +1,276 @@
+import gzip
+import json
+import sys
+import time
+
+try:
+    from .db_loader import db, db_session, entities, argument_parser, \
+        use_definition
+    from .vis_pony import get_references
+except ModuleNotFoundError:
+    from db_loader import db, db_session, entities, argument_parser, \
+        use_definition
+    from vis_pony import get_references
+
+
+def _column_references(entity):
+    return [attr for attr in get_references(entity)
+            if attr.columns and not attr.is_collection]
+
+
+def _levels(skipped):
+    """
+    Returns the levels of dependency_levels ignoring the references in
+    skipped, and the entities left out by a cycle of the others.
+    """
+    depends_on = {
+        entity: {attr.py_type.__name__ for attr in _column_references(entity)
+                 if attr not in skipped} - {entity}
+        for entity in entities}
+    done = set()
+    levels = []
+    while len(done) < len(depends_on):
+        level = [entity for entity, targets in depends_on.items()
+                 if entity not in done and targets <= done]
+        if not level:
+            return levels, [entity for entity in depends_on
+                            if entity not in done]
+        levels.append(level)
+        done.update(level)
+    return levels, []
+
+
+def _reaches(start, goal, references):
+    seen, pending = set(), [start]
+    while pending:
+        entity = pending.pop()
+        if entity == goal:
+            return True
+        if entity not in seen:
+            seen.add(entity)
+            pending += [attr.py_type.__name__ for attr in references
+                        if attr.entity.__name__ == entity]
+    return False
+
+
+def deferred_references():
+    """
+    Returns the optional references to leave empty while inserting rows
+    and to set once every row exists, as they close a reference cycle: the
+    self references, and one reference per cycle of the others, in
+    definition order.
+    """
+    deferred = [attr for entity in entities
+                for attr in _column_references(entity)
+                if attr.py_type.__name__ == entity and not attr.is_required]
+    while True:
+        _, cycle = _levels(deferred)
+        references = [attr for entity in cycle
+                      for attr in _column_references(entity)
+                      if attr.py_type.__name__ in cycle and
+                      attr not in deferred]
+        candidates = [attr for attr in references if not attr.is_required
+                      and _reaches(attr.py_type.__name__,
+                                   attr.entity.__name__, references)]
+        if not candidates:
+            return deferred
+        deferred.append(candidates[0])
+
+
+def dependency_levels():
+    """
+    Groups the entities in levels such that every entity only references
+    entities of earlier levels, apart from its deferred_references, so the
+    entities of a level can be filled independently of each other.
+    Entities in cycles of required references, which no rows can satisfy
+    one at a time, form the last level, in definition order.
+    """
+    levels, cycle = _levels(deferred_references())
+    return levels + [cycle] if cycle else levels
+
+
+def dependency_order():
+    return [entity for level in dependency_levels() for entity in level]
+
+
+def table_columns(entity):
+    """Returns the attributes of entity that are stored in its own table."""
+    return [attr for attr in entities[entity]._attrs_
+            if attr.columns and not attr.is_collection]
+
+
+def link_collections():
+    """
+    Returns one attribute per many-to-many relationship, the side whose
+    link rows are written to the dump.
+    """
+    links = []
+    for entity in entities:
+        for attr in entities[entity]._attrs_:
+            if not attr.is_collection or not attr.reverse.is_collection:
+                continue
+            reverse = (attr.reverse.entity.__name__, attr.reverse.name)
+            if attr.symmetric or (entity, attr.name) < reverse:
+                links.append(attr)
+    return links
+
+
+def iter_rows(entity, chunk_size=1000, convert=True):
+    """
+    Yields the table columns of entity's rows, chunk_size rows at a time,
+    with keyset pagination over the id. Without convert the values are
+    given as stored in the database.
+    """
+    quote = db._db.provider.quote_name
+    attrs = table_columns(entity)
+    id_col = quote(entities[entity]._pk_columns_[0])
+    select = (f'SELECT {", ".join(quote(a.column) for a in attrs)} '
+              f'FROM {quote(entities[entity]._table_)}')
+    first = f'{select} ORDER BY {id_col} LIMIT $chunk_size'
+    following = (f'{select} WHERE {id_col} > $last '
+                 f'ORDER BY {id_col} LIMIT $chunk_size')
+    converters = [a.converters[0].sql2py for a in attrs]
+    params = {'chunk_size': chunk_size}
+    sql = first
+    while True:
+        with db_session:
+            chunk = db._db.select(sql, params)
+        if not chunk:
+            return
+        if convert:
+            yield [[None if value is None else sql2py(value)
+                    for sql2py, value in zip(converters, row)]
+                   for row in chunk]
+        else:
+            yield [list(row) for row in chunk]
+        params['last'] = chunk[-1][0]
+        sql = following
+
+
+def iter_links(attr, chunk_size=1000):
+    """
+    Yields the links of a many-to-many attribute as [id, [ids]] rows, with
+    keyset pagination over the link table.
+    """
+    quote = db._db.provider.quote_name
+    owner_columns = attr.reverse_columns if attr.symmetric else \
+        attr.reverse.columns
+    owner, item = quote(owner_columns[0]), quote(attr.columns[0])
+    select = f'SELECT {owner}, {item} FROM {quote(attr.table)}'
+    order = f'ORDER BY {owner}, {item} LIMIT $chunk_size'
+    first = f'{select} {order}'
+    # a row value comparison lets SQLite search the primary key from the
+    # last link rather than scan it from the start
+    following = f'{select} WHERE ({owner}, {item}) > ($owner, $item) {order}'
+    params = {'chunk_size': chunk_size}
+    sql = first
+    while True:
+        with db_session:
+            chunk = db._db.select(sql, params)
+        if not chunk:
+            return
+        rows = []
+        for owner_id, item_id in chunk:
+            if rows and rows[-1][0] == owner_id:
+                rows[-1][1].append(item_id)
+            else:
+                rows.append([owner_id, [item_id]])
+        yield rows
+        params['owner'], params['item'] = chunk[-1]
+        sql = following
+
+
+def iter_references(attr, chunk_size=1000):
+    """
+    Yields the [id, id] rows of the entries whose reference attr is set,
+    with keyset pagination over the id.
+    """
+    quote = db._db.provider.quote_name
+    entity = attr.entity
+    id_col, column = quote(entity._pk_columns_[0]), quote(attr.column)
+    select = (f'SELECT {id_col}, {column} FROM {quote(entity._table_)} '
+              f'WHERE {column} IS NOT NULL')
+    order = f'ORDER BY {id_col} LIMIT $chunk_size'
+    first = f'{select} {order}'
+    following = f'{select} AND {id_col} > $last {order}'
+    params = {'chunk_size': chunk_size}
+    sql = first
+    while True:
+        with db_session:
+            chunk = db._db.select(sql, params)
+        if not chunk:
+            return
+        yield [list(row) for row in chunk]
+        params['last'] = chunk[-1][0]
+        sql = following
+
+
+def _write(f, item):
+    f.write(json.dumps(item, default=str) + '\n')
+
+
+def export(path, chunk_size=1000, compress=None, report=sys.stderr):
+    """
+    Writes every row of the database to path as JSON Lines ('-' for stdout).
+
+    Tables are written in dependency order, each introduced by a
+    {"table": ..., "columns": [...]} line followed by one list of values per
+    row; references are written as ids. Many-to-many collections follow as
+    {"collection": "Entity.attr", "columns": ["id", attr]} sections of
+    [id, [ids]] rows, and the deferred_references, left out of the table
+    rows, as {"references": "Entity.attr", "columns": ["id", attr]}
+    sections of [id, id] rows. The output is gzip compressed if compress
+    is set or path ends with .gz.
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    if path == '-':
+        f = gzip.open(sys.stdout.buffer, 'wt') if compress else sys.stdout
+    else:
+        f = gzip.open(path, 'wt') if compress else open(path, 'w')
+    deferred = deferred_references()
+    try:
+        for entity in dependency_order():
+            start = time.perf_counter()
+            attrs = table_columns(entity)
+            kept = [i for i, attr in enumerate(attrs) if attr not in deferred]
+            _write(f, {'table': entity,
+                       'columns': [attrs[i].name for i in kept]})
+            total = 0
+            for chunk in iter_rows(entity, chunk_size):
+                for row in chunk:
+                    _write(f, [row[i] for i in kept])
+                total += len(chunk)
+            print(f'{entity}: {total} rows in '
+                  f'{time.perf_counter() - start:.1f}s', file=report)
+        for attr in link_collections():
+            name = f'{attr.entity.__name__}.{attr.name}'
+            _write(f, {'collection': name, 'columns': ['id', attr.name]})
+            for chunk in iter_links(attr, chunk_size):
+                for row in chunk:
+                    _write(f, row)
+            print(f'{name}: links written', file=report)
+        for attr in deferred:
+            name = f'{attr.entity.__name__}.{attr.name}'
+            _write(f, {'references': name, 'columns': ['id', attr.name]})
+            for chunk in iter_references(attr, chunk_size):
+                for row in chunk:
+                    _write(f, row)
+            print(f'{name}: references written', file=report)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == '__main__':
+    parser = argument_parser('Exports the contents of a database as JSON '
+                             'Lines, ordered so that it can be loaded back '
+                             'with pony_utils.load --dump')
+    parser.add_argument('output', help="file to write, '-' for stdout")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='rows read per query')
+    parser.add_argument('--gzip', action='store_true', default=None,
+                        help='compress the output (default for .gz files)')
+    args = parser.parse_args()
+    use_definition(args.definition)
+    export(args.output, args.chunk_size, args.gzip)
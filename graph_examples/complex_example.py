@@ -2,7 +2,6 @@ from pony import orm
 from pony.orm import Required, Optional, Set, db_session, show, composite_key
 from decimal import Decimal
 import datetime as dtt
-import pandas as pd
 
 
 ###############################################################################
@@ -18,6 +17,9 @@ class Helper:
         class_name = type(self).__name__
         return '<' + class_name + self.label() + '>'
 
+    def label(self):
+        return f'[{self.id}]'
+
 
 ###############################################################################
 # INSTITUTION
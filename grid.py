@@ -0,0 +1,279 @@
+import re
+
+import dash_core_components as dcc
+import dash_html_components as html
+import dash_table
+from dash.dependencies import Input, Output, State
+
+try:
+    from .db_loader import db, entities
+    from .metrics import read_session, timed
+    from .pony_table import PonyTable, label, get_table_and_id_from_repr, \
+        get_table_counts, get_labels
+except ModuleNotFoundError:
+    from db_loader import db, entities
+    from metrics import read_session, timed
+    from pony_table import PonyTable, label, get_table_and_id_from_repr, \
+        get_table_counts, get_labels
+
+GRID_PAGE_SIZE = 25
+# filtered tables are counted up to this many rows, so that a filter
+# matching millions of rows does not need a full scan to show its first page
+GRID_COUNT_LIMIT = 100000
+
+# operators of the DataTable filter syntax and their SQL equivalents
+_OPERATORS = {'=': '=', 'eq': '=', '!=': '<>', 'ne': '<>', '<': '<',
+              'lt': '<', '<=': '<=', 'le': '<=', '>': '>', 'gt': '>',
+              '>=': '>=', 'ge': '>=', 'contains': 'LIKE',
+              'icontains': 'LIKE', 'scontains': 'LIKE',
+              'datestartswith': 'LIKE'}
+_FILTER_PART = re.compile(
+    r'\s*\{(?P<column>[^}]+)\}\s*(?P<operator>' +
+    '|'.join(sorted(map(re.escape, _OPERATORS), key=len, reverse=True)) +
+    r')\s*(?P<value>.*?)\s*$', re.IGNORECASE)
+
+
+def grid_columns(table_name):
+    """
+    Returns the Columns of table_name shown in the grid: those stored in
+    the entity's own table, i.e. everything but collections.
+    """
+    table = PonyTable(table_name)
+    return [column for column in table.columns.values()
+            if column.kind is not table.SET and
+            table.get_attribute(column.name).columns]
+
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+        return value[1:-1]
+    return value
+
+
+def parse_filter(table_name, filter_query):
+    """
+    Turns a DataTable filter_query ('{column} op value && ...') into an SQL
+    condition and its parameters. References are compared by id and can be
+    given as ids or entry reprs.
+    """
+    if not filter_query:
+        return '', {}
+    table = PonyTable(table_name)
+    columns = {column.name: column for column in grid_columns(table_name)}
+    quote = db._db.provider.quote_name
+    conditions = []
+    params = {}
+    for i, part in enumerate(filter_query.split(' && ')):
+        match = _FILTER_PART.match(part)
+        if not match:
+            raise ValueError(f'Cannot parse filter {part!r}')
+        name = match.group('column')
+        if name not in columns:
+            raise ValueError(f'{table_name} has no column {name}')
+        column = columns[name]
+        operator = _OPERATORS[match.group('operator').lower()]
+        value = _unquote(match.group('value'))
+        if column.kind is table.REFERENCE:
+            table_name_id = get_table_and_id_from_repr(value)
+            value = table_name_id[1] if table_name_id else value
+        if operator == 'LIKE':
+            value = re.sub(r'([%_\\])', r'\\\1', str(value))
+            if match.group('operator').lower().endswith('contains'):
+                value = '%' + value
+            value += '%'
+        elif column.kind in (table.ID, table.REFERENCE):
+            value = int(value)
+        elif column.kind is table.BOOL:
+            value = value.lower() in ('1', 'true', 'yes')
+        params[f'filter{i}'] = value
+        sql = (f'{quote(table.get_attribute(name).column)} {operator} '
+               f'$filter{i}')
+        if operator == 'LIKE':
+            sql += " ESCAPE '\\'"
+        conditions.append(sql)
+    return ' WHERE ' + ' AND '.join(conditions), params
+
+
+def _key_segments(sort_sql, id_sql, nullable, descending, after):
+    """
+    Returns (condition, order) pairs reading, one after the other, the
+    rows that follow the (sort value, id) key after, or every row if after
+    is None, walking the sort column and the id descending or ascending.
+    SQLite puts NULL before every value, and rows cannot be compared to a
+    NULL key, so the rows with a NULL sort value are read by id in a
+    segment of their own.
+    """
+    direction = 'DESC' if descending else 'ASC'
+    greater = '<' if descending else '>'
+    if sort_sql is None:
+        condition = f'{id_sql} {greater} $after_id' if after else ''
+        return [(condition, f'{id_sql} {direction}')]
+    values = (f'({sort_sql}, {id_sql}) {greater} ($after_value, $after_id)'
+              if after and after[0] is not None else
+              f'{sort_sql} IS NOT NULL' if nullable else '',
+              f'{sort_sql} {direction}, {id_sql} {direction}')
+    if not nullable:
+        return [values]
+    nulls = (f'{sort_sql} IS NULL' +
+             (f' AND {id_sql} {greater} $after_id'
+              if after and after[0] is None else ''),
+             f'{id_sql} {direction}')
+    if after is None:
+        return [values, nulls] if descending else [nulls, values]
+    if after[0] is None:
+        return [nulls] if descending else [nulls, values]
+    return [values, nulls] if descending else [values]
+
+
+@read_session
+def get_grid_page(table_name, page_current=0, page_size=GRID_PAGE_SIZE,
+                  sort_by=(), filter_query='', keys=None):
+    """
+    Returns one page of table_name as DataTable records, the number of
+    pages and the (sort value, id) keys of its first and last rows.
+    Sorting, filtering and paging all happen in SQL, so only the rows of
+    the page are read, and references are rendered with the labels of
+    get_labels. keys maps the pages read before to their keys: a page next
+    to one of them is read from its key on (keyset pagination), any other
+    with an OFFSET. The grid sorts by one column, whose index, if any,
+    serves the pages read by key.
+    """
+    entity = entities[table_name]
+    table = PonyTable(table_name)
+    columns = grid_columns(table_name)
+    quote = db._db.provider.quote_name
+    sql_columns = {c.name: quote(table.get_attribute(c.name).column)
+                   for c in columns}
+    where, params = parse_filter(table_name, filter_query)
+    from_ = f'FROM {quote(entity._table_)}{where}'
+    if where:
+        total = db._db.select(
+            f'SELECT COUNT(*) FROM (SELECT 1 {from_} LIMIT $count_limit)',
+            dict(params, count_limit=GRID_COUNT_LIMIT))[0]
+    else:
+        total = get_table_counts()[table_name]
+
+    sort_by = list(sort_by or ())
+    if len(sort_by) > 1:
+        raise ValueError('The grid sorts by one column at a time')
+    id_sql = quote(entity._pk_columns_[0])
+    sort_sql, nullable, descending = None, False, False
+    if sort_by:
+        name = sort_by[0]['column_id']
+        if name not in sql_columns:
+            raise ValueError(f'{table_name} has no column {name}')
+        descending = sort_by[0]['direction'] == 'desc'
+        attr = table.get_attribute(name)
+        if sql_columns[name] != id_sql:
+            sort_sql, nullable = sql_columns[name], bool(attr.nullable)
+    select = [*sql_columns.values(), sort_sql or id_sql, id_sql]
+    keys = {int(page): key for page, key in (keys or {}).items()}
+    if page_current - 1 in keys:
+        after, backwards = keys[page_current - 1][1], False
+    elif page_current + 1 in keys:
+        after, backwards = keys[page_current + 1][0], True
+    else:
+        after, backwards = None, False
+    if after is not None:
+        params.update(after_value=after[0], after_id=after[1])
+    segments = _key_segments(sort_sql, id_sql, nullable,
+                             descending != backwards, after)
+    offset = ''
+    if page_current and after is None:
+        # no neighbouring page to start from
+        direction = 'DESC' if descending else 'ASC'
+        segments = [('', ', '.join(f'{column} {direction}'
+                                   for column in (sort_sql, id_sql)
+                                   if column))]
+        offset = ' OFFSET $offset'
+        params['offset'] = page_current * page_size
+    rows = []
+    for condition, order in segments:
+        if len(rows) == page_size:
+            break
+        if condition:
+            condition = f' {"AND" if where else "WHERE"} {condition}'
+        params['limit'] = page_size - len(rows)
+        rows += db._db.select(
+            f'SELECT {", ".join(select)} {from_}{condition} '
+            f'ORDER BY {order} LIMIT $limit{offset}', params)
+    if backwards:
+        rows.reverse()
+    page_keys = rows and [list(rows[0][-2:]), list(rows[-1][-2:])]
+
+    records = [dict(zip(sql_columns, row)) for row in rows]
+    for column in columns:
+        if column.kind is table.REFERENCE:
+            ids = {r[column.name] for r in records} - {None}
+            labels = get_labels(column.target, ids)
+            for record in records:
+                label_repr = labels.get(record[column.name])
+                record[column.name] = label_repr and label_repr[0]
+        elif column.kind is not table.ID:
+            convert = table.get_attribute(column.name).converters[0].sql2py
+            render = {table.DATE: label, table.DECIMAL: str}.get(
+                column.kind, lambda value: value)
+            for record in records:
+                value = record[column.name]
+                if value is not None:
+                    value = render(convert(value))
+                record[column.name] = value
+    page_count = max(-(-total // page_size), 1)
+    return records, page_count, page_keys
+
+
+def get_grid():
+    return html.Div([
+        dash_table.DataTable(
+            id='entry-grid', columns=[], data=[],
+            page_action='custom', page_current=0, page_size=GRID_PAGE_SIZE,
+            sort_action='custom', sort_mode='single', sort_by=[],
+            filter_action='custom', filter_query=''),
+        # keys of the pages shown, see get_grid_page
+        dcc.Store(id='entry-grid-keys')])
+
+
+def assign_grid_callbacks(app):
+
+    @app.callback([Output('entry-grid', 'page_current'),
+                   Output('entry-grid', 'sort_by'),
+                   Output('entry-grid', 'filter_query')],
+                  [Input('table-dropdown', 'value')])
+    def reset_grid(table_name):
+        return 0, [], ''
+
+    @app.callback([Output('entry-grid', 'columns'),
+                   Output('entry-grid', 'data'),
+                   Output('entry-grid', 'page_count'),
+                   Output('entry-grid-keys', 'data')],
+                  [Input('table-dropdown', 'value'),
+                   Input('entry-grid', 'page_current'),
+                   Input('entry-grid', 'page_size'),
+                   Input('entry-grid', 'sort_by'),
+                   Input('entry-grid', 'filter_query'),
+                   Input('entity-versions', 'data')],
+                  [State('entry-grid-keys', 'data')])
+    @timed('callback:update_grid')
+    def update_grid(table_name, page_current, page_size, sort_by,
+                    filter_query, versions, grid_keys):
+        if not table_name:
+            return [], [], 1, None
+        columns = [{'name': column.name, 'id': column.name}
+                   for column in grid_columns(table_name)]
+        query = [table_name, page_size, sort_by, filter_query]
+        keys = {}
+        if grid_keys and grid_keys['query'] == query:
+            keys = grid_keys['keys']
+        page_current = page_current or 0
+        try:
+            data, page_count, page_keys = get_grid_page(
+                table_name, page_current, page_size, sort_by, filter_query,
+                keys)
+        except ValueError:
+            # a filter typed for another table, or not finished yet
+            return columns, [], 1, None
+        if page_keys:
+            keys = dict(keys, **{str(page_current): page_keys})
+        return columns, data, page_count, {'query': query, 'keys': keys}
+
+    return app
@@ -0,0 +1,290 @@
+import csv
+import datetime as dtt
+import decimal
+import gzip
+import json
+import sys
+import time
+from collections import defaultdict
+
+try:
+    from .db_loader import db_session, entities, argument_parser, \
+        use_definition
+    from .pony_table import PonyTable, IN_BATCH_SIZE, \
+        get_table_and_id_from_repr
+except ModuleNotFoundError:
+    from db_loader import db_session, entities, argument_parser, \
+        use_definition
+    from pony_table import PonyTable, IN_BATCH_SIZE, \
+        get_table_and_id_from_repr
+
+# separates the members of a SET column in a CSV cell
+SET_SEPARATOR = ';'
+TRUE_STRINGS = {'1', 'true', 't', 'yes', 'y'}
+
+
+def read_rows(path, fmt=None):
+    """
+    Yields the rows of a CSV file or a JSON Lines file (one object per line)
+    as dicts, one at a time.
+    """
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    with open(path, newline='') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        elif fmt == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f'Unknown format {fmt}, expected csv or jsonl')
+
+
+def batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class RowConverter:
+    """
+    Turns rows read from a file into keyword arguments of an entity, typing
+    every value according to its PonyTable column. REFERENCE and SET values
+    are either entry reprs or values of the target's natural key.
+    """
+
+    def __init__(self, table_name):
+        self.table = PonyTable(table_name)
+
+    def _keys(self, column, value):
+        if value is None or value == '':
+            return []
+        if column.kind is PonyTable.SET and isinstance(value, str):
+            return [v.strip() for v in value.split(SET_SEPARATOR) if v]
+        return value if isinstance(value, list) else [value]
+
+    def _resolve(self, target, keys):
+        """Returns a dict from key to entry with one query per 500 keys."""
+        natural_key = PonyTable(target).natural_key()
+        entity = entities[target]
+        by_key = defaultdict(list)
+        for key in keys:
+            table_name_id = (get_table_and_id_from_repr(key)
+                             if isinstance(key, str) else None)
+            if table_name_id:
+                by_key['id'].append((key, table_name_id[1]))
+            elif natural_key == 'id':
+                by_key['id'].append((key, int(key)))
+            else:
+                by_key[natural_key].append((key, key))
+        found = {}
+        for attr_name, pairs in by_key.items():
+            values = sorted({value for _, value in pairs})
+            entries = {}
+            for start in range(0, len(values), IN_BATCH_SIZE):
+                batch = values[start:start + IN_BATCH_SIZE]
+                entries.update(
+                    (getattr(e, attr_name), e) for e in entity.select(
+                        lambda e: getattr(e, attr_name) in batch))
+            found.update((key, entries.get(value)) for key, value in pairs)
+        missing = [str(key) for key, entry in found.items() if entry is None]
+        if missing:
+            raise ValueError(f'Unknown {target} entries: ' +
+                             ', '.join(missing))
+        return found
+
+    def _convert(self, column, value, entries):
+        if column.kind is PonyTable.SET:
+            return [entries[column.name][key]
+                    for key in self._keys(column, value)]
+        elif column.kind is PonyTable.REFERENCE:
+            keys = self._keys(column, value)
+            return entries[column.name][keys[0]] if keys else None
+        elif value is None:
+            return None
+        elif column.kind is PonyTable.DECIMAL:
+            return decimal.Decimal(str(value)) if value != '' else None
+        elif not isinstance(value, str):
+            # already typed by the JSON decoder
+            return value
+        elif column.kind is PonyTable.ID:
+            return int(value) if value else None
+        elif column.kind is PonyTable.DATE:
+            return dtt.datetime.fromisoformat(value) if value else None
+        elif column.kind is PonyTable.BOOL:
+            return value.strip().lower() in TRUE_STRINGS
+        return value
+
+    def convert(self, rows):
+        """
+        Converts a batch of rows. Must be called inside a db_session, as
+        references are resolved with one query per column and batch.
+        """
+        columns = self.table.columns
+        for row in rows:
+            unknown = set(row) - set(columns)
+            if unknown:
+                raise ValueError(f'{self.table.table_name} has no columns '
+                                 f'{sorted(unknown)}')
+        entries = {}
+        for column in columns.values():
+            if column.kind in (PonyTable.SET, PonyTable.REFERENCE):
+                keys = {key for row in rows
+                        for key in self._keys(column, row.get(column.name))}
+                entries[column.name] = self._resolve(column.target, keys)
+        output = []
+        for row in rows:
+            kwargs = {key: self._convert(columns[key], value, entries)
+                      for key, value in row.items()}
+            if kwargs.get('id') is None:
+                kwargs.pop('id', None)
+            output.append(kwargs)
+        return output
+
+
+def load(table_name, path, batch_size=1000, fmt=None, report=sys.stderr):
+    """
+    Streams the rows of path into table_name, committing one transaction
+    per batch_size rows, and returns the number of rows inserted.
+    """
+    converter = RowConverter(table_name)
+    entity = entities[table_name]
+    start = time.perf_counter()
+    total = 0
+    for batch in batches(read_rows(path, fmt), batch_size):
+        with db_session:
+            for kwargs in converter.convert(batch):
+                entity(**kwargs)
+        total += len(batch)
+        elapsed = time.perf_counter() - start
+        print(f'{table_name}: {total} rows in {elapsed:.1f}s '
+              f'({total / elapsed:.0f} rows/s)', file=report)
+    return total
+
+
+def read_dump(path, batch_size):
+    """
+    Yields (header, rows) pairs of at most batch_size rows from a dump
+    written by pony_utils.export.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    header, batch = None, []
+    with opener(path, 'rt') as f:
+        for line in f:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                if batch:
+                    yield header, batch
+                header, batch = item, []
+            else:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    yield header, batch
+                    batch = []
+    if batch:
+        yield header, batch
+
+
+def _get_by_ids(entity, ids):
+    entries = {}
+    for chunk in batches(sorted(set(ids)), IN_BATCH_SIZE):
+        entries.update((e.id, e) for e in entity.select(
+            lambda e: e.id in chunk))
+    return entries
+
+
+def insert_rows(entity, columns, rows):
+    """
+    Inserts rows given as lists of values of columns, keeping their ids.
+    Must be called inside a db_session.
+    """
+    for row in rows:
+        entity(**dict(zip(columns, row)))
+
+
+def add_links(entity, key, rows):
+    """
+    Adds [id, [ids]] rows to the many-to-many collection key of entity,
+    fetching the entries with one query per 500 ids. Must be called inside
+    a db_session.
+    """
+    target = getattr(entity, key).py_type
+    owners = _get_by_ids(entity, [id_ for id_, _ in rows])
+    items = _get_by_ids(target, [i for _, ids in rows for i in ids])
+    for owner_id, ids in rows:
+        getattr(owners[owner_id], key).add([items[i] for i in ids])
+
+
+def set_references(entity, key, rows):
+    """
+    Sets the reference key of entity from [id, id] rows, fetching the
+    entries with one query per 500 ids. Must be called inside a
+    db_session.
+    """
+    target = getattr(entity, key).py_type
+    owners = _get_by_ids(entity, [id_ for id_, _ in rows])
+    items = _get_by_ids(target, [item_id for _, item_id in rows])
+    for owner_id, item_id in rows:
+        setattr(owners[owner_id], key, items[item_id])
+
+
+def restore(path, batch_size=1000, report=sys.stderr):
+    """
+    Loads a dump written by pony_utils.export into an empty database built
+    from the same definition, keeping the ids of every entry. The
+    references sections, which close reference cycles, are set once the
+    rows they point to exist. Returns the number of rows inserted.
+    """
+    start = time.perf_counter()
+    total = 0
+    counts = defaultdict(int)
+    for header, rows in read_dump(path, batch_size):
+        with db_session:
+            if 'table' in header:
+                name = header['table']
+                insert_rows(entities[name], header['columns'], rows)
+            elif 'collection' in header:
+                name = header['collection']
+                table_name, key = name.split('.')
+                add_links(entities[table_name], key, rows)
+            else:
+                name = header['references']
+                table_name, key = name.split('.')
+                set_references(entities[table_name], key, rows)
+        counts[name] += len(rows)
+        total += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {counts[name]} rows, {total} in total in '
+              f'{elapsed:.1f}s ({total / elapsed:.0f} rows/s)', file=report)
+    return total
+
+
+if __name__ == '__main__':
+    parser = argument_parser('Loads a CSV or JSON Lines file into an entity, '
+                             'or a dump written by pony_utils.export')
+    parser.add_argument('table', nargs='?',
+                        help='entity to insert the rows into')
+    parser.add_argument('file', nargs='?',
+                        help='CSV file with a header row or JSON Lines file '
+                             'with one object per row')
+    parser.add_argument('--dump', help='dump to restore into an empty '
+                                       'database instead of a single file')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='rows inserted per transaction')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='defaults to jsonl for .jsonl/.ndjson files '
+                             'and csv otherwise')
+    args = parser.parse_args()
+    if not args.dump and not (args.table and args.file):
+        parser.error('either table and file or --dump are required')
+    use_definition(args.definition)
+    if args.dump:
+        restore(args.dump, args.batch_size)
+    else:
+        load(args.table, args.file, args.batch_size, args.format)
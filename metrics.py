@@ -0,0 +1,284 @@
+import functools
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from pony.orm import db_session
+from pony.orm.core import local
+
+try:
+    from .db_loader import db
+except ModuleNotFoundError:
+    from db_loader import db
+
+logger = logging.getLogger(__name__)
+
+# number of recent calls per name the percentiles are computed over
+WINDOW = 1000
+QUANTILES = (0.5, 0.9, 0.99)
+# calls slower than this many seconds are logged, None disables the log
+slow_threshold = None
+
+_frames = threading.local()
+_lock = threading.Lock()
+_samples = defaultdict(lambda: deque(maxlen=WINDOW))
+_totals = defaultdict(lambda: [0, 0.0, 0, 0])
+
+
+class _Frame:
+
+    __slots__ = ('start', 'statements', 'rows')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+
+
+def _active_frames():
+    if not hasattr(_frames, 'stack'):
+        _frames.stack = []
+    return _frames.stack
+
+
+class _CountingCursor:
+    """Passes every call to cursor, counting the rows fetched from it."""
+
+    def __init__(self, cursor, frames):
+        self._cursor = cursor
+        self._frames = frames
+
+    def _count(self, rows):
+        for frame in self._frames:
+            frame.rows += rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def instrument_database(database):
+    """
+    Makes the pony Database count the SQL statements it executes and the
+    rows fetched by them towards the calls that are being timed.
+    """
+    if getattr(database, '_metrics_instrumented', False):
+        return
+    exec_sql = database._exec_sql
+
+    @functools.wraps(exec_sql)
+    def counting_exec_sql(*args, **kwargs):
+        result = exec_sql(*args, **kwargs)
+        frames = list(_active_frames())
+        for frame in frames:
+            frame.statements += 1
+        if frames and hasattr(result, 'fetchall'):
+            result = _CountingCursor(result, frames)
+        return result
+
+    database._exec_sql = counting_exec_sql
+    database._metrics_instrumented = True
+
+
+def record(name, duration, statements, rows):
+    with _lock:
+        _samples[name].append((duration, statements, rows))
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += statements
+        totals[3] += rows
+    if slow_threshold is not None and duration > slow_threshold:
+        logger.warning('slow %s: %.3fs, %d statements, %d rows', name,
+                       duration, statements, rows)
+
+
+class timed:
+    """
+    Records the wall time, SQL statements and rows fetched of a block or,
+    used as a decorator, of every call of a function under name.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        frame = _Frame()
+        _active_frames().append(frame)
+        return frame
+
+    def __exit__(self, *exc_info):
+        frame = _active_frames().pop()
+        record(self.name, time.perf_counter() - frame.start, frame.statements,
+               frame.rows)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def _pending_callbacks():
+    if not hasattr(_frames, 'after_session'):
+        _frames.after_session = []
+    return _frames.after_session
+
+
+def after_session(callback):
+    """
+    Calls callback once the outermost session opened by a @session function
+    has ended, i.e. after its commit, or straight away outside of sessions.
+    """
+    if local.db_session is None:
+        callback()
+    else:
+        _pending_callbacks().append(callback)
+
+
+def _run_callbacks():
+    callbacks = _pending_callbacks()
+    while callbacks:
+        callbacks.pop(0)()
+
+
+def session(func):
+    """
+    Like @db_session, but records the call under 'session:<name>' whenever
+    it opens the outermost session, and runs the after_session callbacks
+    registered within it when it ends. Nested calls run func directly,
+    without setting up a nested db_session.
+    """
+    timed_func = timed(f'session:{func.__qualname__}')(db_session(func))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if local.db_session is not None:
+            return func(*args, **kwargs)
+        try:
+            return timed_func(*args, **kwargs)
+        finally:
+            _run_callbacks()
+    return wrapper
+
+
+def _modified_entities():
+    return any(cache.modified for cache in local.db2cache.values())
+
+
+def read_connection():
+    """
+    Returns the DB-API connection of the current db_session the way pony's
+    own selects get it. Database.get_connection would start an immediate
+    transaction instead, taking the write lock.
+    """
+    return db._db._get_cache().prepare_connection_for_query_execution()
+
+
+@contextmanager
+def _query_only():
+    """
+    Makes SQLite refuse every write on the connection of the current
+    db_session while the block runs, so that read sessions never take the
+    write lock. Other providers are left as they are.
+    """
+    database = db._db
+    if database.provider_name != 'sqlite':
+        yield
+        return
+    connection = read_connection()
+    connection.execute('PRAGMA query_only = ON')
+    try:
+        yield
+    finally:
+        try:
+            connection.execute('PRAGMA query_only = OFF')
+        except sqlite3.ProgrammingError:
+            # closed after an error, so it is never handed out again
+            pass
+
+
+def read_session(func):
+    """
+    Like @session for functions that only read: the connection is made
+    query-only for the length of the session, so that raw SQL writes fail,
+    and if func modified an entity, the session is rolled back and a
+    ValueError raised instead of committing.
+    """
+    name = f'session:{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if local.db_session is not None:
+            return func(*args, **kwargs)
+        try:
+            with timed(name), db_session, _query_only():
+                result = func(*args, **kwargs)
+                if _modified_entities():
+                    raise ValueError(f'{func.__qualname__} modified entities '
+                                     'within a read-only session')
+                return result
+        finally:
+            _run_callbacks()
+    return wrapper
+
+
+def _quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def prometheus_text():
+    """Returns every recorded name as summaries in Prometheus text format."""
+    with _lock:
+        samples = {name: list(values) for name, values in _samples.items()}
+        totals = {name: list(values) for name, values in _totals.items()}
+    metrics = [('pony_utils_duration_seconds', 'wall time', 0, 1),
+               ('pony_utils_sql_statements', 'SQL statements executed', 1, 2),
+               ('pony_utils_rows_fetched', 'rows fetched', 2, 3)]
+    lines = []
+    for metric, description, index, total_index in metrics:
+        lines += [f'# HELP {metric} {description} of callbacks and sessions',
+                  f'# TYPE {metric} summary']
+        for name in sorted(samples):
+            values = [sample[index] for sample in samples[name]]
+            for q in QUANTILES:
+                lines.append(f'{metric}{{name="{name}",quantile="{q}"}} '
+                             f'{_quantile(values, q)}')
+            lines.append(f'{metric}_sum{{name="{name}"}} '
+                         f'{totals[name][total_index]}')
+            lines.append(f'{metric}_count{{name="{name}"}} '
+                         f'{totals[name][0]}')
+    return '\n'.join(lines) + '\n'
+
+
+def register_endpoint(server, path='/metrics'):
+    """Serves prometheus_text on the given path of a Flask server."""
+    def metrics():
+        return prometheus_text(), 200, {
+            'Content-Type': 'text/plain; version=0.0.4'}
+    server.add_url_rule(path, 'pony_utils_metrics', metrics)
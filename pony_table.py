@@ -0,0 +1,753 @@
+import datetime as dtt
+import decimal
+import hashlib
+import logging
+from collections import defaultdict
+
+try:
+    from . import cache
+    from .db_loader import db, entities
+    from .metrics import session, read_session, after_session
+except ModuleNotFoundError:
+    import cache
+    from db_loader import db, entities
+    from metrics import session, read_session, after_session
+
+logger = logging.getLogger(__name__)
+
+# SQLite refuses compound selects with more than 500 terms
+_COUNT_BATCH = 400
+
+
+def _count_tables(table_names):
+    """
+    Counts the rows of every table in table_names using a single UNION ALL
+    query per batch instead of one round trip per table.
+    """
+    quote = db._db.provider.quote_name
+    counts = {}
+    for start in range(0, len(table_names), _COUNT_BATCH):
+        batch = table_names[start:start + _COUNT_BATCH]
+        sql = ' UNION ALL '.join(
+            f'SELECT {i}, COUNT(*) FROM {quote(entities[name]._table_)}'
+            for i, name in enumerate(batch))
+        counts.update({batch[i]: count for i, count in db._db.select(sql)})
+    return counts
+
+
+def _dependent_tables(table_name):
+    """
+    Returns table_name together with every table whose rows are removed
+    by cascade when a row of table_name is deleted.
+    """
+    tables = {table_name}
+    stack = [table_name]
+    while stack:
+        for attr in entities[stack.pop()]._attrs_:
+            if attr.reverse is None or not attr.cascade_delete:
+                continue
+            dependent = attr.reverse.entity.__name__
+            if dependent not in tables:
+                tables.add(dependent)
+                stack.append(dependent)
+    return tables
+
+
+def bump_versions(*table_names):
+    """
+    Bumps the cache versions of table_names, straight away for this process
+    and again once the writing session has committed, so that no worker
+    keeps what it read from the database in between.
+    """
+    cache.bump(*table_names)
+    after_session(lambda: cache.bump(*table_names))
+
+
+@read_session
+def get_table_counts():
+    counts = cache.cached_many('count', list(entities),
+                               lambda table: [table], _count_tables)
+    return {table: counts[table] for table in entities}
+
+
+@read_session
+def label(val, use_label=True):
+    if use_label and isinstance(val, db._db.Entity):
+        return _entry_label(val)
+    elif use_label and hasattr(val, 'label'):
+        return val.label()
+    elif isinstance(val, dtt.datetime):
+        date_str = val.strftime('%Y-%m-%d')
+        no_hour_min = val.hour == val.minute == 0
+        time_str = '' if no_hour_min else ' ' + val.strftime('%H:%M')
+        return date_str + time_str
+    elif isinstance(val, str):
+        return val
+    elif val is not None:
+        return repr(val)
+
+
+def get_table_and_id_from_repr(entry_repr):
+    if '[' in entry_repr:
+        start_bracket = entry_repr.index('[')
+        end_bracket = entry_repr.index(']')
+        table_name = entry_repr[1:start_bracket]
+        id_ = int(entry_repr[start_bracket+1:end_bracket])
+        return table_name, id_
+
+
+@read_session
+def get_entry_from_repr(entry_repr):
+    table_name_id = get_table_and_id_from_repr(entry_repr)
+    if table_name_id:
+        return entities[table_name_id[0]][table_name_id[1]]
+
+
+# keeps the number of bound parameters below SQLite's limit
+IN_BATCH_SIZE = 500
+
+
+@read_session
+def get_entries_from_reprs(entry_reprs):
+    """
+    Resolves many entry reprs at once with one primary key query per entity
+    and returns a dict from repr to entry. Reprs that do not name an entry
+    (e.g. 'None') map to None. A ValueError listing every unknown entry is
+    raised if any of them does not exist.
+    """
+    ids = defaultdict(set)
+    entries = {}
+    for entry_repr in entry_reprs:
+        table_name_id = (get_table_and_id_from_repr(entry_repr)
+                         if entry_repr else None)
+        if table_name_id:
+            ids[table_name_id[0]].add(table_name_id[1])
+        else:
+            entries[entry_repr] = None
+    found = {}
+    missing = []
+    for table_name, table_ids in ids.items():
+        if table_name not in entities:
+            missing += [f'{table_name}[{id_}]' for id_ in sorted(table_ids)]
+            continue
+        entity = entities[table_name]
+        table_ids = sorted(table_ids)
+        for start in range(0, len(table_ids), IN_BATCH_SIZE):
+            batch = table_ids[start:start + IN_BATCH_SIZE]
+            found.update(((table_name, e.id), e)
+                         for e in entity.select(lambda e: e.id in batch))
+        missing += [f'{table_name}[{id_}]' for id_ in table_ids
+                    if (table_name, id_) not in found]
+    if missing:
+        raise ValueError('Unknown entries: ' + ', '.join(missing))
+    for entry_repr in entry_reprs:
+        if entry_repr not in entries:
+            entries[entry_repr] = found[
+                get_table_and_id_from_repr(entry_repr)]
+    return entries
+
+
+# called as listener(action, entry) by the writes of PonyTable inside their
+# db_session, action being 'add', 'modify' or 'delete'
+write_listeners = []
+
+
+def _notify_write(action, entry):
+    for listener in write_listeners:
+        listener(action, entry)
+
+
+# called as listener(action, table_name, ids) by bulk writes, which change
+# rows with set-based SQL and never load them as entries
+bulk_write_listeners = []
+
+
+def _notify_bulk_write(action, table_name, ids):
+    for listener in bulk_write_listeners:
+        listener(action, table_name, ids)
+
+
+LABEL_TABLE = 'pony_utils_labels'
+# rows written per INSERT, four parameters each
+_LABEL_BATCH = 200
+# ids of the databases whose labels are materialized in LABEL_TABLE
+_label_databases = set()
+_label_versions = {}
+
+
+def label_dependencies(table_name):
+    """
+    Returns the entities the labels of table_name are computed from: the
+    entity itself and those named by its label_depends_on attribute, e.g.
+    label_depends_on = ('Table2', 'Table3') for a label made from the names
+    of an entry's table2 and table3.
+    """
+    names = getattr(entities[table_name], 'label_depends_on', ())
+    unknown = [name for name in names if name not in entities]
+    if unknown:
+        raise ValueError(f'{table_name}.label_depends_on names unknown '
+                         f'entities: {", ".join(unknown)}')
+    return {table_name, *names}
+
+
+def _label_dependents(table_names):
+    """Returns the other entities whose labels depend on table_names."""
+    written = set(table_names)
+    return {name for name in entities
+            if name not in written and written & label_dependencies(name)}
+
+
+def _digest_code(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _digest_code(const, digest)
+        elif isinstance(const, frozenset):
+            # the order of a set depends on the hash seed of the process
+            digest.update(repr(sorted(map(repr, const))).encode())
+        else:
+            digest.update(repr(const).encode())
+
+
+def label_version(table_name):
+    """
+    Returns the version of the labels of table_name: its label_version
+    attribute if it sets one, or else a digest of the code of its label()
+    and __repr__ methods, so that editing them outdates the labels
+    materialized before.
+    """
+    entity = entities[table_name]
+    if entity not in _label_versions:
+        version = getattr(entity, 'label_version', None)
+        if version is None:
+            digest = hashlib.sha1()
+            for method in ('label', '__repr__'):
+                code = getattr(getattr(entity, method, None), '__code__',
+                               None)
+                if code is not None:
+                    _digest_code(code, digest)
+            version = digest.hexdigest()[:16]
+        _label_versions[entity] = str(version)
+    return _label_versions[entity]
+
+
+def _compute_label(entry):
+    return entry.label() if hasattr(entry, 'label') else repr(entry)
+
+
+def _compute_labels(table_name, ids):
+    """Returns a dict from id to (label, repr) computed from the entries."""
+    entity = entities[table_name]
+    ids = sorted(ids)
+    labels = {}
+    for start in range(0, len(ids), IN_BATCH_SIZE):
+        batch = ids[start:start + IN_BATCH_SIZE]
+        labels.update((entry.id, (_compute_label(entry), repr(entry)))
+                      for entry in entity.select(lambda e: e.id in batch))
+    return labels
+
+
+def _entry_label(entry):
+    table_name = type(entry).__name__
+    return cache.cached(
+        'label', (table_name, entry.id), label_dependencies(table_name),
+        lambda: (_compute_label(entry), repr(entry)))[0]
+
+
+def label_table_enabled():
+    return id(db._db) in _label_databases
+
+
+def _create_label_table():
+    create = (f'CREATE TABLE IF NOT EXISTS {LABEL_TABLE} '
+              '(entity VARCHAR(255) NOT NULL, id INTEGER NOT NULL, '
+              'version VARCHAR(40) NOT NULL, label TEXT, repr TEXT, '
+              'PRIMARY KEY (entity, id))')
+    db._db.execute(create)
+    cursor = db._db.execute(f'SELECT * FROM {LABEL_TABLE} WHERE 1 = 0')
+    if 'version' not in [column[0] for column in cursor.description]:
+        # materialized before labels had versions
+        db._db.execute(f'DROP TABLE {LABEL_TABLE}')
+        db._db.execute(create)
+
+
+@session
+def enable_label_table(fill=True):
+    """
+    Materializes labels in LABEL_TABLE from now on, creating it in the
+    database if needed; otherwise they are only cached in memory. fill
+    computes the labels missing from the table for every entity straight
+    away, as reading labels never writes them. Must be called outside of
+    db_session, once the definition is loaded.
+    """
+    _create_label_table()
+    _label_databases.add(id(db._db))
+    if fill:
+        for table_name in entities:
+            fill_labels(table_name)
+
+
+def _check_label_table():
+    if not label_table_enabled():
+        raise ValueError('Labels are not materialized, see '
+                         'enable_label_table')
+
+
+@session
+def forget_labels(table_name, ids):
+    """
+    Forgets the materialized labels of the entries ids of table_name, and
+    those depending on them, see _forget_dependent_labels.
+    """
+    if not label_table_enabled():
+        return
+    for start in range(0, len(ids), IN_BATCH_SIZE):
+        batch = ', '.join(str(int(id_))
+                          for id_ in ids[start:start + IN_BATCH_SIZE])
+        db._db.execute(f'DELETE FROM {LABEL_TABLE} WHERE entity = $entity '
+                       f'AND id IN ({batch})', {'entity': table_name})
+    _forget_dependent_labels(table_name, ids)
+
+
+def _forget_all_labels(table_names):
+    for table_name in sorted(table_names):
+        db._db.execute(f'DELETE FROM {LABEL_TABLE} WHERE entity = $entity',
+                       {'entity': table_name})
+
+
+def _forget_dependent_labels(table_name, ids):
+    """
+    Forgets the materialized labels of the other entities that depend on
+    the entries ids of table_name. Only the entries referring to them are
+    forgotten where the dependent entity has a reference to table_name;
+    the dependents related to it otherwise, e.g. through a collection,
+    lose all of their labels, as their entries cannot be told apart.
+    """
+    if not label_table_enabled() or not ids:
+        return
+    quote = db._db.provider.quote_name
+    for dependent in sorted(_label_dependents([table_name])):
+        entity = entities[dependent]
+        columns = [quote(attr.column) for attr in entity._attrs_
+                   if attr.columns and not attr.is_collection and
+                   attr.py_type is entities[table_name]]
+        if not columns:
+            _forget_all_labels([dependent])
+            continue
+        select = (f'SELECT {quote(entity._pk_columns_[0])} '
+                  f'FROM {quote(entity._table_)}')
+        for start in range(0, len(ids), IN_BATCH_SIZE):
+            batch = ', '.join(str(int(id_))
+                              for id_ in ids[start:start + IN_BATCH_SIZE])
+            referring = ' OR '.join(f'{column} IN ({batch})'
+                                    for column in columns)
+            db._db.execute(f'DELETE FROM {LABEL_TABLE} '
+                           'WHERE entity = $entity '
+                           f'AND id IN ({select} WHERE {referring})',
+                           {'entity': dependent})
+
+
+@session
+def store_labels(table_name, entries):
+    """
+    Computes the labels of entries and writes them to LABEL_TABLE, over
+    the ones stored before. Does nothing unless labels are materialized.
+    """
+    if not label_table_enabled():
+        return
+    version = label_version(table_name)
+    labels = [(entry.id, _compute_label(entry), repr(entry))
+              for entry in entries]
+    for start in range(0, len(labels), _LABEL_BATCH):
+        params = {'entity': table_name, 'version': version}
+        values = []
+        for i, (id_, label_, repr_) in enumerate(
+                labels[start:start + _LABEL_BATCH]):
+            params[f'label{i}'], params[f'repr{i}'] = label_, repr_
+            values.append(f'($entity, {int(id_)}, $version, $label{i}, '
+                          f'$repr{i})')
+        db._db.execute(f'INSERT INTO {LABEL_TABLE} '
+                       '(entity, id, version, label, repr) '
+                       f'VALUES {", ".join(values)} '
+                       'ON CONFLICT (entity, id) DO UPDATE SET '
+                       'version = excluded.version, '
+                       'label = excluded.label, repr = excluded.repr',
+                       params)
+
+
+@session
+def fill_labels(table_name):
+    """
+    Computes the labels of the entries of table_name missing from
+    LABEL_TABLE, or stored with another label_version, IN_BATCH_SIZE
+    entries at a time, and returns their number. Labels forgotten because
+    an entity of label_dependencies changed are missing until it runs.
+    """
+    _check_label_table()
+    entity = entities[table_name]
+    quote = db._db.provider.quote_name
+    id_col = quote(entity._pk_columns_[0])
+    missing = db._db.select(
+        f'SELECT t.{id_col} FROM {quote(entity._table_)} t '
+        f'LEFT JOIN {LABEL_TABLE} l ON l.entity = $entity '
+        f'AND l.id = t.{id_col} AND l.version = $version '
+        'WHERE l.id IS NULL',
+        {'entity': table_name, 'version': label_version(table_name)})
+    for start in range(0, len(missing), IN_BATCH_SIZE):
+        batch = missing[start:start + IN_BATCH_SIZE]
+        store_labels(table_name, entity.select(lambda e: e.id in batch))
+    return len(missing)
+
+
+@read_session
+def get_labels(table_name, ids):
+    """
+    Returns a dict from id to (label, repr) for the existing entries of
+    table_name among ids. Labels are read from the cache, then LABEL_TABLE
+    if labels are materialized, and only computed from the entries that
+    are in neither. They are cached until table_name or another entity of
+    its label_dependencies changes.
+    """
+    def read(keys):
+        labels = _read_labels(table_name, [id_ for _, id_ in keys])
+        return {(table_name, id_): labels[id_] for id_ in labels}
+
+    labels = cache.cached_many('label', [(table_name, id_) for id_ in ids],
+                               label_dependencies(table_name), read)
+    return {id_: label_repr for (_, id_), label_repr in labels.items()}
+
+
+def _read_labels(table_name, ids):
+    labels = {}
+    missing = sorted(set(ids))
+    if missing and label_table_enabled():
+        params = {'entity': table_name,
+                  'version': label_version(table_name)}
+        for start in range(0, len(missing), IN_BATCH_SIZE):
+            batch = ', '.join(str(int(id_)) for id_ in
+                              missing[start:start + IN_BATCH_SIZE])
+            labels.update((id_, (label_, repr_)) for id_, label_, repr_ in
+                          db._db.select(f'SELECT id, label, repr '
+                                        f'FROM {LABEL_TABLE} '
+                                        f'WHERE entity = $entity '
+                                        f'AND version = $version '
+                                        f'AND id IN ({batch})', params))
+        missing = [id_ for id_ in missing if id_ not in labels]
+    labels.update(_compute_labels(table_name, missing))
+    return labels
+
+
+@session
+def clear_labels(*table_names):
+    """
+    Forgets the labels of table_names and of the entities whose labels
+    depend on them, e.g. after rows of them were replaced by other means
+    than PonyTable.
+    """
+    if label_table_enabled():
+        _forget_all_labels(set(table_names) |
+                           _label_dependents(table_names))
+    bump_versions(*table_names)
+
+
+def entry_option(entry):
+    return {'label': label(entry), 'value': repr(entry)}
+
+
+class CollectionPage(list):
+    """
+    The first page of a collection together with the collection's size.
+    """
+
+    # value standing in for the members of a collection that were not loaded
+    REST_PREFIX = 'rest-of-collection:'
+
+    def __init__(self, entries, total):
+        super().__init__(entries)
+        self.total = total
+
+    @property
+    def is_partial(self):
+        return self.total > len(self)
+
+    def rest_option(self):
+        return {'label': f'... and {self.total - len(self)} more',
+                'value': f'{self.REST_PREFIX}{self.total - len(self)}'}
+
+    @classmethod
+    def is_rest(cls, value):
+        return isinstance(value, str) and value.startswith(cls.REST_PREFIX)
+
+
+class Column:
+    """
+    Immutable description of an entity attribute, computed once per entity
+    so that rendering and unpacking forms needs no ORM reflection.
+    """
+
+    __slots__ = ('name', 'kind', 'component_property', 'is_unique',
+                 'is_required', 'target')
+
+    def __init__(self, name, kind, component_property, is_unique,
+                 is_required, target):
+        values = (name, kind, component_property, is_unique, is_required,
+                  target)
+        for slot, value in zip(self.__slots__, values):
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __repr__(self):
+        return f'Column({self.name!r}, kind={self.kind}, target={self.target})'
+
+
+class PonyTable:
+
+    ID = 0
+    SET = 1
+    REFERENCE = 2
+    DATE = 3
+    STR = 4
+    BOOL = 5
+    DECIMAL = 6
+
+    COMPONENT_PROPERTY = {ID: 'children', SET: 'value', REFERENCE: 'value',
+                          DATE: 'date', STR: 'value', BOOL: 'values',
+                          DECIMAL: 'value'}
+
+    COLLECTION_PAGE_SIZE = 50
+
+    _columns = {}
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    @property
+    def table(self):
+        return entities[self.table_name]
+
+    @property
+    def columns(self):
+        """Maps each column name of the table to its Column descriptor."""
+        try:
+            return self._columns[self.table_name]
+        except KeyError:
+            return self.compile_columns()
+
+    def compile_columns(self):
+        columns = {}
+        for attr in self.table._attrs_:
+            kind = self._get_attribute_kind(attr)
+            target = (attr.py_type.__name__
+                      if kind in (self.SET, self.REFERENCE) else None)
+            columns[attr.name] = Column(
+                attr.name, kind, self.COMPONENT_PROPERTY[kind],
+                attr.is_unique, attr.is_required, target)
+        self._columns[self.table_name] = columns
+        return columns
+
+    @property
+    def table_cols(self):
+        return list(self.columns)
+
+    @read_session
+    def _unpack_args(self, args):
+        columns_args = list(zip(self.columns.values(), args))
+        reprs = []
+        for column, arg in columns_args:
+            if column.kind is self.SET:
+                reprs += [e for e in arg or []
+                          if not CollectionPage.is_rest(e)]
+            elif column.kind is self.REFERENCE:
+                reprs.append(arg)
+        entries = get_entries_from_reprs(reprs)
+        output = {}
+        for column, arg in columns_args:
+            col_type = column.kind
+            if col_type is self.SET:
+                arg = [entries[e] for e in arg or []
+                       if not CollectionPage.is_rest(e)]
+            elif col_type is self.REFERENCE:
+                logger.debug('%r %s', arg, type(arg))
+                arg = entries[arg]
+            elif col_type is self.DATE:
+                arg = dtt.datetime.fromisoformat(arg) if arg else None
+            elif col_type is self.DECIMAL:
+                arg = decimal.Decimal(arg) if arg not in (None, '') else None
+            elif col_type is self.BOOL:
+                arg = len(arg) > 0
+                logger.debug('%r', arg)
+            output[column.name] = arg
+        return output
+
+    def _get_type(self, key):
+        return self.columns[key].kind
+
+    def _get_attribute_kind(self, attr):
+        attr_type = attr.py_type
+        if isinstance(attr, db.Set):
+            return self.SET
+        elif attr_type in entities.values():
+            return self.REFERENCE
+        elif attr_type is dtt.datetime:
+            return self.DATE
+        elif attr_type is str:
+            return self.STR
+        elif attr_type is bool:
+            return self.BOOL
+        elif attr_type is decimal.Decimal:
+            return self.DECIMAL
+        elif attr.name == 'id':
+            return self.ID
+        else:
+            raise ValueError(f'Unknown type for {self.table_name}: '
+                             f'{attr.name} - ({attr}, {attr_type})')
+
+    def none_val(self, key):
+        attr_type = self._get_type(key)
+        if attr_type == self.SET:
+            return []
+        elif attr_type == self.REFERENCE:
+            return None
+        elif attr_type == self.DATE:
+            return None
+        elif attr_type == self.STR:
+            return ''
+        elif attr_type == self.BOOL:
+            raise ValueError('BOOL type cannot have a None equivalent')
+        elif attr_type == self.DECIMAL:
+            raise ValueError('DECIMAL type cannot have a None equivalent')
+        elif key == 'id':
+            raise ValueError('ID type cannot have a None equivalent')
+
+    def _collection_page(self, collection):
+        return collection.select().order_by(
+            lambda e: e.id)[:self.COLLECTION_PAGE_SIZE]
+
+    @read_session
+    def get_entry(self, id_):
+        """
+        Returns the columns of an entry, with references given as reprs.
+        Collections are loaded as their size and first COLLECTION_PAGE_SIZE
+        members only (see CollectionPage), so opening an entry costs the
+        same however large its collections are. Entries are cached until
+        their entity or an entity they refer to changes.
+        """
+        depends_on = {self.table_name} | {
+            column.target for column in self.columns.values()
+            if column.kind in (self.SET, self.REFERENCE)}
+        return cache.cached('entry', (self.table_name, id_), depends_on,
+                            lambda: self._read_entry(id_))
+
+    def _read_entry(self, id_):
+        entry = self.table[id_]
+        e_dict = entry.to_dict(related_objects=True)
+        for column in self.columns.values():
+            if column.kind is self.SET:
+                collection = getattr(entry, column.name)
+                e_dict[column.name] = CollectionPage(
+                    map(repr, self._collection_page(collection)),
+                    collection.count())
+            elif column.kind is self.REFERENCE:
+                value = e_dict.get(column.name)
+                e_dict[column.name] = None if value is None else repr(value)
+        return e_dict
+
+    def get_attribute(self, key):
+        return getattr(self.table, key)
+
+    def is_unique(self, key):
+        return self.columns[key].is_unique
+
+    def is_required(self, key):
+        return self.columns[key].is_required
+
+    def natural_key(self):
+        """
+        Returns the first unique column other than the id, which identifies
+        entries outside of the database, or 'id' if there is none.
+        """
+        for column in self.columns.values():
+            if column.is_unique and column.kind is not self.ID:
+                return column.name
+        return 'id'
+
+    @session
+    def add_entry(self, args):
+        e_dict = self._unpack_args(args)
+        if 'id' in e_dict:
+            e_dict.pop('id')
+        entry = entities[self.table_name](**e_dict)
+        entry.flush()
+        store_labels(self.table_name, [entry])
+        _notify_write('add', entry)
+        bump_versions(self.table_name)
+
+    @session
+    def modify_entry(self, args):
+        """
+        Writes only the submitted columns whose value differs from the stored
+        one. Collections are updated with the added and removed entries only;
+        when the form kept the placeholder for the members it did not load,
+        only the loaded first page can be removed from. Returns the number of
+        fields written.
+        """
+        partial = {column.name
+                   for column, arg in zip(self.columns.values(), args)
+                   if column.kind is self.SET and
+                   any(CollectionPage.is_rest(e) for e in arg or [])}
+        e_dict = self._unpack_args(args)
+        current_entry = self.table[e_dict['id']]
+        current = current_entry.to_dict()
+        written = 0
+        for key, value in e_dict.items():
+            col_type = self._get_type(key)
+            if col_type is self.ID:
+                continue
+            elif col_type is self.SET:
+                collection = getattr(current_entry, key)
+                submitted = {entry.id for entry in value}
+                if key in partial:
+                    members = list(self._collection_page(collection))
+                    members += collection.select(lambda e: e.id in submitted)
+                else:
+                    members = collection
+                stored = {entry.id for entry in members}
+                added = [entry for entry in value if entry.id not in stored]
+                removed = [entry for entry in members
+                           if entry.id not in submitted]
+                if added:
+                    collection.add(added)
+                if removed:
+                    collection.remove(removed)
+                changed = bool(added or removed)
+            else:
+                stored = current.get(key)
+                if col_type is self.REFERENCE and value is not None:
+                    value_cmp = value.get_pk()
+                else:
+                    value_cmp = value
+                changed = value_cmp != stored
+                if changed:
+                    setattr(current_entry, key, value)
+            if changed:
+                logger.debug('%r %s %r', current_entry, key, value)
+                written += 1
+        if written:
+            store_labels(self.table_name, [current_entry])
+            _forget_dependent_labels(self.table_name, [current_entry.id])
+            _notify_write('modify', current_entry)
+            bump_versions(self.table_name)
+        return written
+
+    @session
+    def delete_entry(self, args):
+        e_dict = self._unpack_args(args)
+        if e_dict['id']:
+            entry = entities[self.table_name][e_dict['id']]
+            _notify_write('delete', entry)
+            forget_labels(self.table_name, [entry.id])
+            entry.delete()
+            bump_versions(*_dependent_tables(self.table_name))
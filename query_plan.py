@@ -0,0 +1,450 @@
+import json
+import re
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    from .db_loader import db, db_session, entities, argument_parser, \
+        use_definition
+    from .metrics import read_session, read_connection
+    from .pony_table import PonyTable, get_table_counts
+    from . import cache
+except ModuleNotFoundError:
+    from db_loader import db, db_session, entities, argument_parser, \
+        use_definition
+    from metrics import read_session, read_connection
+    from pony_table import PonyTable, get_table_counts
+    import cache
+
+# runs timed per statement when measuring the indexes applied
+REPEAT = 20
+# characters of each statement shown in the report
+SQL_WIDTH = 110
+
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\S+)(?: AS (\S+))?$')
+_NAME = r'("[^"]+"|\w+)'
+_TABLE_REF = re.compile(
+    rf'\b(?:FROM|JOIN)\s+{_NAME}(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|ON|LEFT|'
+    rf'INNER|CROSS|ORDER|GROUP|LIMIT|UNION|USING)\b){_NAME})?',
+    re.IGNORECASE)
+_LIMIT = re.compile(r'\bLIMIT\s+\S+(?:\s+OFFSET\s+\S+)?\s*$', re.IGNORECASE)
+_ORDER_BY = re.compile(rf'\bORDER\s+BY\s+(?:{_NAME}\.)?("[^"]+")',
+                       re.IGNORECASE)
+_PREDICATE = re.compile(rf'(?:{_NAME}\.)?("[^"]+")\s*(?:=|IN\s*\()',
+                        re.IGNORECASE)
+
+
+def _check_provider():
+    if db._db.provider.dialect != 'SQLite':
+        raise ValueError('Query plans are read with EXPLAIN QUERY PLAN, '
+                         f'which needs an SQLite database, not '
+                         f'{db._db.provider.dialect}')
+
+
+def _unquote(name):
+    return name[1:-1] if name.startswith('"') else name
+
+
+def _shorten(sql):
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= SQL_WIDTH else sql[:SQL_WIDTH - 3] + '...'
+
+
+@contextmanager
+def capture_statements():
+    """
+    Records the (sql, arguments) of every statement the loaded database
+    executes within the block in the list it yields.
+    """
+    database = db._db
+    patched = '_exec_sql' in vars(database)
+    exec_sql = database._exec_sql
+    statements = []
+
+    def recording_exec_sql(sql, arguments=None, *args, **kwargs):
+        statements.append((sql, arguments))
+        return exec_sql(sql, arguments, *args, **kwargs)
+
+    database._exec_sql = recording_exec_sql
+    try:
+        yield statements
+    finally:
+        if patched:
+            database._exec_sql = exec_sql
+        else:
+            del database._exec_sql
+
+
+@read_session
+def _first_id(table_name):
+    entity = entities[table_name]
+    quote = db._db.provider.quote_name
+    return db._db.select(f'SELECT MIN({quote(entity._pk_columns_[0])}) '
+                         f'FROM {quote(entity._table_)}')[0]
+
+
+def representative_paths(table_name):
+    """
+    Returns (name, function) pairs calling the read paths of the entry
+    form, the entry dropdown, the grid and the delete preview on
+    table_name the way the interface does, for its first entry.
+    """
+    # imported here, so that the command line does not load Dash
+    try:
+        from .bulk import preview_delete
+        from .db_admin import _get_entry_dropdown_options
+        from .grid import get_grid_page, grid_columns
+    except ModuleNotFoundError:
+        from bulk import preview_delete
+        from db_admin import _get_entry_dropdown_options
+        from grid import get_grid_page, grid_columns
+
+    table = PonyTable(table_name)
+    id_ = _first_id(table_name)
+    paths = [
+        ('dropdown', lambda: _get_entry_dropdown_options(table_name)),
+        ('dropdown_after',
+         lambda: _get_entry_dropdown_options(table_name, after=id_ or 0)),
+        ('dropdown_search',
+         lambda: _get_entry_dropdown_options(table_name, '1')),
+        ('grid', lambda: get_grid_page(table_name)),
+    ]
+    for column in grid_columns(table_name):
+        if column.kind is table.ID:
+            continue
+        paths.append((f'grid_sort:{column.name}',
+                      lambda name=column.name: get_grid_page(
+                          table_name,
+                          sort_by=[{'column_id': name, 'direction': 'asc'}])))
+        if column.kind is table.REFERENCE:
+            paths.append((f'grid_filter:{column.name}',
+                          lambda name=column.name: get_grid_page(
+                              table_name, filter_query=f'{{{name}}} = 1')))
+    # the searches of the reference and collection dropdowns of the form
+    targets = {column.target for column in table.columns.values()
+               if column.kind in (table.SET, table.REFERENCE)}
+    paths += [(f'options_search:{target}',
+               lambda target=target: _get_entry_dropdown_options(target, '1'))
+              for target in sorted(targets)]
+    if id_ is not None:
+        paths += [
+            ('get_entry', lambda: table.get_entry(id_)),
+            ('preview_delete', lambda: preview_delete(table_name, ids=[id_])),
+        ]
+    return paths
+
+
+def collect_statements(table_names=None):
+    """
+    Runs the representative paths of every entity of table_names (all of
+    them by default) on an empty cache and returns a dict from each SELECT
+    they issue to its first arguments, the paths issuing it and the number
+    of times it ran.
+    """
+    paths = [('counts', get_table_counts)]
+    for table_name in table_names or entities:
+        paths += [(f'{table_name}:{name}', path)
+                  for name, path in representative_paths(table_name)]
+    statements = {}
+    for name, path in paths:
+        cache.clear()
+        with capture_statements() as captured:
+            path()
+        for sql, arguments in captured:
+            if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+                continue
+            found = statements.setdefault(
+                sql, {'arguments': arguments, 'paths': [], 'runs': 0})
+            if name not in found['paths']:
+                found['paths'].append(name)
+            found['runs'] += 1
+    return statements
+
+
+@read_session
+def explain(sql, arguments=None):
+    """Returns the details of the EXPLAIN QUERY PLAN rows of sql."""
+    rows = read_connection().execute(
+        'EXPLAIN QUERY PLAN ' + sql, arguments or ()).fetchall()
+    return [row[-1] for row in rows]
+
+
+@read_session
+def _table_columns():
+    """Returns a dict from every table of the database to its columns."""
+    connection = read_connection()
+    quote = db._db.provider.quote_name
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")]
+    return {table: [row[1] for row in connection.execute(
+        f'PRAGMA table_info({quote(table)})')] for table in tables}
+
+
+@read_session
+def existing_indexes(table):
+    """
+    Returns the column lists of the indexes of table, its primary key
+    included.
+    """
+    connection = read_connection()
+    quote = db._db.provider.quote_name
+    info = connection.execute(f'PRAGMA table_info({quote(table)})').fetchall()
+    primary_key = [row[1] for row in sorted(info, key=lambda row: row[5])
+                   if row[5]]
+    indexes = [primary_key] if primary_key else []
+    for index in connection.execute(
+            f'PRAGMA index_list({quote(table)})').fetchall():
+        indexes.append([row[2] for row in connection.execute(
+            f'PRAGMA index_info({quote(index[1])})')])
+    return indexes
+
+
+def _names(sql):
+    """Returns a dict from the names sql gives its tables to the tables."""
+    names = {}
+    for match in _TABLE_REF.finditer(sql):
+        table = _unquote(match.group(1))
+        names[table] = table
+        if match.group(2):
+            names[_unquote(match.group(2))] = table
+    return names
+
+
+def full_scans(sql, plan, tables):
+    """
+    Returns the tables among tables that plan reads in full. A statement
+    without conditions that walks a table in the order of its rows and ends
+    with a LIMIT stops there, so its table is not counted.
+    """
+    if _LIMIT.search(sql) and not re.search(r'\bWHERE\b', sql, re.I) and \
+            not any('TEMP B-TREE' in detail for detail in plan):
+        return []
+    names = _names(sql)
+    scanned = []
+    for detail in plan:
+        match = _FULL_SCAN.match(detail)
+        if match:
+            table = names.get(match.group(2) or match.group(1),
+                              match.group(1))
+            if table in tables and table not in scanned:
+                scanned.append(table)
+    return scanned
+
+
+def lookups(sql, tables):
+    """
+    Returns the (table, column) pairs sql compares by = or IN, for the
+    columns of tables.
+    """
+    names = _names(sql)
+    found = set()
+    for match in _PREDICATE.finditer(sql):
+        column = _unquote(match.group(2))
+        if match.group(1):
+            candidates = [names.get(_unquote(match.group(1)))]
+        else:
+            candidates = set(names.values())
+        found.update((table, column) for table in candidates
+                     if column in tables.get(table, ()))
+    return found
+
+
+def orderings(sql, plan, tables):
+    """
+    Returns the (table, column) pairs of the first column sql sorts by,
+    for the columns of tables, if plan sorts the rows in a temporary
+    B-tree rather than reading them in the order of an index.
+    """
+    if not any('TEMP B-TREE FOR ORDER BY' in detail for detail in plan):
+        return set()
+    names = _names(sql)
+    match = _ORDER_BY.search(sql)
+    if not match:
+        return set()
+    column = _unquote(match.group(2))
+    if match.group(1):
+        candidates = [names.get(_unquote(match.group(1)))]
+    else:
+        candidates = set(names.values())
+    return {(table, column) for table in candidates
+            if column in tables.get(table, ())}
+
+
+def key_columns():
+    """
+    Yields (table, columns, reason) for the columns rows are looked up by:
+    references, the owner side of many-to-many link tables and composite
+    keys.
+    """
+    for name, entity in entities.items():
+        for attr in entity._attrs_:
+            if attr.is_collection:
+                if attr.symmetric:
+                    yield attr.table, tuple(attr.reverse_columns), \
+                        f'many-to-many {name}.{attr.name}'
+                elif attr.reverse.is_collection:
+                    yield attr.table, tuple(attr.reverse.columns), \
+                        f'many-to-many {name}.{attr.name}'
+            elif attr.reverse and attr.columns:
+                yield entity._table_, tuple(attr.columns), \
+                    f'reference {name}.{attr.name}'
+        for index in entity._indexes_:
+            if not index.is_pk and len(index.attrs) > 1:
+                columns = sum((list(a.columns) for a in index.attrs), [])
+                yield entity._table_, tuple(columns), f'composite key {name}'
+
+
+def propose_indexes(statements, tables):
+    """
+    Returns the indexes worth creating: those on key_columns, or on the
+    columns compared or sorted by in statements reading a table in full,
+    that some statement reading the table in full looks rows up or sorts
+    them by and that no existing index starts with. Each is a dict with
+    its table, columns, CREATE INDEX statement, reasons and number of full
+    scans it avoids.
+    """
+    quote = db._db.provider.quote_name
+    candidates = {}
+    for table, columns, reason in key_columns():
+        candidates.setdefault((table, columns), []).append(reason)
+    for found in statements.values():
+        for table, column in found['lookups']:
+            if table in found['full_scans'] and \
+                    (table, (column,)) not in candidates:
+                candidates.setdefault((table, (column,)), []).append(
+                    'compared in a full scan')
+        for table, column in found['orderings']:
+            if table in found['full_scans']:
+                candidates.setdefault((table, (column,)), []).append(
+                    'sorted in a full scan')
+    proposals = []
+    for (table, columns), reasons in candidates.items():
+        indexes = existing_indexes(table)
+        if any(index[:len(columns)] == list(columns) for index in indexes):
+            continue
+        scans = sum(found['runs'] for found in statements.values()
+                    if table in found['full_scans'] and
+                    (table, columns[0]) in
+                    found['lookups'] | found['orderings'])
+        if not scans:
+            continue
+        name = f'idx_{table.lower()}__{"_".join(columns)}'
+        proposals.append({
+            'table': table, 'columns': list(columns),
+            'sql': f'CREATE INDEX IF NOT EXISTS {quote(name)} '
+                   f'ON {quote(table)} '
+                   f'({", ".join(quote(c) for c in columns)})',
+            'reasons': list(dict.fromkeys(reasons)), 'full_scans': scans})
+    proposals.sort(key=lambda p: (-p['full_scans'], p['table'], p['columns']))
+    return proposals
+
+
+@db_session
+def create_indexes(proposals):
+    for proposal in proposals:
+        db._db.execute(proposal['sql'])
+
+
+@read_session
+def measure(sql, arguments=None, repeat=REPEAT):
+    """Returns the median seconds sql takes to run and fetch its rows."""
+    connection = read_connection()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(sql, arguments or ()).fetchall()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def inspect(table_names=None, apply=False, repeat=REPEAT):
+    """
+    Runs EXPLAIN QUERY PLAN on the statements issued by the representative
+    paths, flags those reading a table in full and proposes indexes for
+    the key columns they look rows up by and the columns they sort by.
+    With apply the indexes are created and the statements on their tables
+    are timed before and after. Returns the findings as a dict.
+    """
+    _check_provider()
+    tables = _table_columns()
+    statements = collect_statements(table_names)
+    for sql, found in statements.items():
+        found['plan'] = explain(sql, found['arguments'])
+        found['full_scans'] = full_scans(sql, found['plan'], tables)
+        found['lookups'] = lookups(sql, tables)
+        found['orderings'] = orderings(sql, found['plan'], tables)
+    proposals = propose_indexes(statements, tables)
+    report = {
+        'statements': [
+            {'sql': sql, 'paths': found['paths'], 'runs': found['runs'],
+             'plan': found['plan'], 'full_scans': found['full_scans']}
+            for sql, found in statements.items()],
+        'proposals': proposals,
+        'applied': []}
+    if not apply or not proposals:
+        return report
+    indexed = {proposal['table'] for proposal in proposals}
+    affected = {sql: found for sql, found in statements.items()
+                if indexed & set(_names(sql).values())}
+    before = {sql: measure(sql, found['arguments'], repeat)
+              for sql, found in affected.items()}
+    create_indexes(proposals)
+    for sql, found in affected.items():
+        plan = explain(sql, found['arguments'])
+        report['applied'].append({
+            'sql': sql, 'plan_before': found['plan'], 'plan': plan,
+            'before': before[sql],
+            'after': measure(sql, found['arguments'], repeat)})
+    return report
+
+
+def print_report(report, file=sys.stdout):
+    statements = report['statements']
+    scanning = [s for s in statements if s['full_scans']]
+    print(f'{len(statements)} statements, {len(scanning)} reading a table '
+          'in full', file=file)
+    for statement in scanning:
+        paths = statement['paths']
+        more = f' and {len(paths) - 3} more' if len(paths) > 3 else ''
+        print(f'  SCAN {", ".join(statement["full_scans"])} '
+              f'({statement["runs"]} runs by {", ".join(paths[:3])}{more})',
+              file=file)
+        print(f'    {_shorten(statement["sql"])}', file=file)
+    if not report['proposals']:
+        print('No indexes to propose', file=file)
+    for proposal in report['proposals']:
+        print(f'{proposal["sql"]};  -- {", ".join(proposal["reasons"])}, '
+              f'avoids {proposal["full_scans"]} full scans', file=file)
+    changed = [applied for applied in report['applied']
+               if applied['plan'] != applied['plan_before']]
+    for applied in changed:
+        print(f'{applied["before"] * 1000:.3f}ms -> '
+              f'{applied["after"] * 1000:.3f}ms  '
+              f'{_shorten(applied["sql"])}', file=file)
+    if report['applied']:
+        print(f'{len(report["applied"]) - len(changed)} other statements on '
+              'the indexed tables kept their plan', file=file)
+
+
+if __name__ == '__main__':
+    parser = argument_parser('Explains the queries of the db_admin paths, '
+                             'flags full table scans and proposes indexes')
+    parser.add_argument('--tables', nargs='+',
+                        help='entities whose paths are explained, all by '
+                             'default')
+    parser.add_argument('--apply', action='store_true',
+                        help='create the proposed indexes and time the '
+                             'statements they affect before and after')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='runs timed per statement with --apply')
+    parser.add_argument('--json', action='store_true',
+                        help='print the findings as JSON')
+    args = parser.parse_args()
+    use_definition(args.definition)
+    report = inspect(args.tables, args.apply, args.repeat)
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report)
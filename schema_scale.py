@@ -0,0 +1,229 @@
+import argparse
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SIZES = (10, 50, 100, 500, 1000, 2000)
+# entities per banner section of the generated definition
+SECTION_SIZE = 25
+BANNER = '#' * 79
+
+HEADER = f'''from pony import orm
+from pony.orm import Required, Optional, Set, db_session, composite_key
+from decimal import Decimal
+import datetime as dtt
+
+
+{BANNER}
+# DATABASE DEFINITION
+{BANNER}
+
+_db = orm.Database()
+'''
+
+FOOTER = f'''
+
+{BANNER}
+# CONNECT TO DATABASE
+{BANNER}
+orm.set_sql_debug(False)
+_db.bind(provider='sqlite', filename={{filename!r}}, create_db=True)
+_db.generate_mapping(create_tables=True)
+
+commit = _db.commit
+select = orm.select
+entities = _db.entities
+
+# hack to overcome pyflakes thinking that variables aren't used
+db_session = db_session
+'''
+
+
+def generate_definition(n, references=2.0, set_ratio=0.2,
+                        composite_ratio=0.1, seed=0, filename=':memory:'):
+    """
+    Returns the source of a definition module in the style of
+    graph_examples/define_ponyorm.py with n entities. Every entity has on
+    average references relationships to other entities, set_ratio of which
+    are many-to-many, and composite_ratio of the entities have a composite
+    key.
+    """
+    rng = random.Random(seed)
+    names = [f'Table{i}' for i in range(1, n + 1)]
+    position = {name: i for i, name in enumerate(names)}
+    # only the attribute types PonyTable has a form component for
+    attrs = {name: ['    name = Required(str, unique=True)',
+                    '    code = Required(str)',
+                    '    version = Required(Decimal)',
+                    '    amount = Optional(Decimal)',
+                    '    created = Optional(dtt.datetime)']
+             for name in names}
+    for i, name in enumerate(names):
+        count = int(references) + (rng.random() < references % 1)
+        for k in range(count):
+            target = rng.choice(names)
+            attr = f'{target.lower()}_{k}'
+            reverse = f'{name.lower()}s_{k}'
+            if rng.random() < set_ratio:
+                attrs[name].append(
+                    f"    {attr}s = Set('{target}', reverse='{reverse}')")
+                attrs[target].append(
+                    f"    {reverse} = Set('{name}', reverse='{attr}s')")
+            else:
+                # only references to earlier entities may be required, so
+                # that the generated data never needs a cycle of inserts
+                kind = ('Required' if position[target] < i and
+                        rng.random() < 0.5 else 'Optional')
+                attrs[name].append(
+                    f"    {attr} = {kind}('{target}', reverse='{reverse}')")
+                attrs[target].append(
+                    f"    {reverse} = Set('{name}', reverse='{attr}')")
+    for name in names:
+        if rng.random() < composite_ratio:
+            attrs[name].append('    composite_key(code, version)')
+
+    blocks = [HEADER]
+    for i, name in enumerate(names):
+        if i % SECTION_SIZE == 0:
+            blocks.append(f'\n{BANNER}\n# SECTION {i // SECTION_SIZE + 1}'
+                          f'\n{BANNER}')
+        blocks.append(f'class {name}(_db.Entity):\n' +
+                      '\n'.join(attrs[name]) + '\n\n')
+    blocks.append(FOOTER.format(filename=filename))
+    return '\n'.join(blocks)
+
+
+def _seconds(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def measure(definition, vis_format='dot'):
+    """
+    Measures the startup of db_admin on a definition module and returns the
+    results as a dict. Meant to run in a fresh interpreter per definition,
+    see run.
+    """
+    import dash
+    import plotly
+
+    try:
+        from . import db_admin, vis_pony
+        from .db_loader import use_definition
+    except ModuleNotFoundError:
+        import db_admin
+        import vis_pony
+        from db_loader import use_definition
+
+    timings = {}
+    timings['db_loader'], _ = _seconds(use_definition, definition)
+    timings['initialise'], _ = _seconds(db_admin.initialise)
+    app = dash.Dash(__name__)
+    timings['assign_callbacks'], _ = _seconds(db_admin.assign_callbacks, app)
+    timings['get_layout'], layout = _seconds(db_admin.get_layout)
+    payload = json.dumps(layout, cls=plotly.utils.PlotlyJSONEncoder)
+    with tempfile.TemporaryDirectory() as directory:
+        output = Path(directory) / f'schema.{vis_format}'
+        timings['vis_render'], _ = _seconds(
+            vis_pony.render, output, vis_format, None, 1, False, None,
+            directory)
+    return {'seconds': timings, 'layout_bytes': len(payload.encode())}
+
+
+def run(sizes=SIZES, references=2.0, set_ratio=0.2, composite_ratio=0.1,
+        seed=0, vis_format='dot', report=sys.stderr):
+    """
+    Generates a definition per size in sizes and measures each of them in
+    its own interpreter, so that no import or cache is shared between them.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n in sizes:
+            definition = Path(directory) / f'schema_{n}.py'
+            definition.write_text(generate_definition(
+                n, references, set_ratio, composite_ratio, seed))
+            module = f'{__package__}.schema_scale' if __package__ else \
+                'schema_scale'
+            cwd = Path(__file__).parent
+            if __package__:
+                cwd = cwd.parent
+            process = subprocess.run(
+                [sys.executable, '-m', module, 'measure', str(definition),
+                 '--vis-format', vis_format],
+                cwd=cwd, capture_output=True, text=True)
+            if process.returncode:
+                raise RuntimeError(f'Measuring {n} entities failed:\n'
+                                   f'{process.stderr}')
+            result = {'entities': n, **json.loads(process.stdout)}
+            print(f'{n} entities: ' + ', '.join(
+                f'{key} {value:.3f}s'
+                for key, value in result['seconds'].items()) +
+                f', layout {result["layout_bytes"]} bytes', file=report)
+            results.append(result)
+    return {'references': references, 'set_ratio': set_ratio,
+            'composite_ratio': composite_ratio, 'seed': seed,
+            'vis_format': vis_format, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generates wide database definitions and measures how '
+                    'the startup of db_admin scales with them')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_shape_arguments(subparser):
+        subparser.add_argument('--references', type=float, default=2.0,
+                               help='relationships per entity')
+        subparser.add_argument('--set-ratio', type=float, default=0.2,
+                               help='fraction of many-to-many relationships')
+        subparser.add_argument('--composite-ratio', type=float, default=0.1,
+                               help='fraction of entities with a composite '
+                                    'key')
+        subparser.add_argument('--seed', type=int, default=0)
+
+    generate = subparsers.add_parser('generate',
+                                     help='write a definition module')
+    generate.add_argument('entities', type=int)
+    generate.add_argument('output', help="file to write, '-' for stdout")
+    generate.add_argument('--filename', default=':memory:',
+                          help='SQLite file the definition binds to')
+    add_shape_arguments(generate)
+
+    bench = subparsers.add_parser('bench', help='measure the startup for '
+                                                'growing definitions')
+    bench.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    bench.add_argument('--vis-format', default='dot',
+                       help="vis_pony format, 'dot' skips graphviz layout")
+    bench.add_argument('--output', default='-',
+                       help="JSON file to write, '-' for stdout")
+    add_shape_arguments(bench)
+
+    measure_parser = subparsers.add_parser(
+        'measure', help='measure a single definition, printing JSON')
+    measure_parser.add_argument('definition')
+    measure_parser.add_argument('--vis-format', default='dot')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        source = generate_definition(args.entities, args.references,
+                                     args.set_ratio, args.composite_ratio,
+                                     args.seed, args.filename)
+        if args.output == '-':
+            print(source, end='')
+        else:
+            Path(args.output).write_text(source)
+    elif args.command == 'bench':
+        data = run(args.sizes, args.references, args.set_ratio,
+                   args.composite_ratio, args.seed, args.vis_format)
+        text = json.dumps(data, indent=2)
+        if args.output == '-':
+            print(text)
+        else:
+            Path(args.output).write_text(text + '\n')
+    else:
+        print(json.dumps(measure(args.definition, args.vis_format)))
@@ -0,0 +1,264 @@
+import re
+import sys
+import time
+from collections import defaultdict
+
+try:
+    from .db_loader import db, db_session, entities, argument_parser, \
+        use_definition
+    from .metrics import read_session
+    from .pony_table import PonyTable, IN_BATCH_SIZE, write_listeners, \
+        bulk_write_listeners
+except ModuleNotFoundError:
+    from db_loader import db, db_session, entities, argument_parser, \
+        use_definition
+    from metrics import read_session
+    from pony_table import PonyTable, IN_BATCH_SIZE, write_listeners, \
+        bulk_write_listeners
+
+INDEX_TABLE = 'pony_utils_search'
+ENTITY_TABLE = 'pony_utils_search_entities'
+# rowids of the index are number << ID_BITS | id, number identifying the
+# entity in ENTITY_TABLE, so that every entry is found by its rowid
+ID_BITS = 40
+SEARCH_LIMIT = 20
+BUILD_CHUNK = 10000
+
+_numbers = {}
+
+
+def text_columns(table_name):
+    """Returns the attributes of the STR columns of table_name."""
+    table = PonyTable(table_name)
+    return [table.get_attribute(column.name)
+            for column in table.columns.values()
+            if column.kind is table.STR and
+            table.get_attribute(column.name).column]
+
+
+def _check_provider():
+    if db._db.provider.dialect != 'SQLite':
+        raise ValueError('The search index needs an SQLite database, not '
+                         f'{db._db.provider.dialect}')
+
+
+@read_session
+def index_exists():
+    return bool(db._db.select(
+        "SELECT 1 FROM sqlite_master WHERE name = $name",
+        {'name': INDEX_TABLE}))
+
+
+def _entity_number(table_name):
+    """Returns the number of table_name, registering it if it is new."""
+    if table_name not in _numbers:
+        rows = db._db.select(f'SELECT name, number FROM {ENTITY_TABLE}')
+        _numbers.update(rows)
+        if table_name not in _numbers:
+            number = max(_numbers.values(), default=0) + 1
+            db._db.execute(f'INSERT INTO {ENTITY_TABLE} (name, number) '
+                           'VALUES ($name, $number)',
+                           {'name': table_name, 'number': number})
+            _numbers[table_name] = number
+    return _numbers[table_name]
+
+
+def _text(values):
+    return ' '.join(value for value in values if value)
+
+
+@db_session
+def build_index(report=sys.stderr):
+    """
+    (Re)creates the FTS5 index over the STR columns of every entity. Writes
+    through PonyTable keep it up to date afterwards; it needs rebuilding
+    after rows are written by other means, such as pony_utils.load.
+    """
+    _check_provider()
+    quote = db._db.provider.quote_name
+    _numbers.clear()
+    db._db.execute(f'DROP TABLE IF EXISTS {INDEX_TABLE}')
+    db._db.execute(f'DROP TABLE IF EXISTS {ENTITY_TABLE}')
+    db._db.execute(f'CREATE TABLE {ENTITY_TABLE} '
+                   '(name TEXT PRIMARY KEY, number INTEGER UNIQUE)')
+    db._db.execute(f"CREATE VIRTUAL TABLE {INDEX_TABLE} "
+                   "USING fts5(text, prefix='2 3')")
+    connection = db._db.get_connection()
+    for table_name in entities:
+        attrs = text_columns(table_name)
+        if not attrs:
+            continue
+        start = time.perf_counter()
+        offset = _entity_number(table_name) << ID_BITS
+        entity = entities[table_name]
+        id_col = quote(entity._pk_columns_[0])
+        select = (f'SELECT {id_col}, '
+                  f'{", ".join(quote(a.column) for a in attrs)} '
+                  f'FROM {quote(entity._table_)}')
+        params = {'chunk': BUILD_CHUNK, 'last': 0}
+        total = 0
+        while True:
+            rows = db._db.select(f'{select} WHERE {id_col} > $last '
+                                 f'ORDER BY {id_col} LIMIT $chunk', params)
+            if not rows:
+                break
+            connection.executemany(
+                f'INSERT INTO {INDEX_TABLE} (rowid, text) VALUES (?, ?)',
+                [(offset | row[0], _text(row[1:])) for row in rows])
+            params['last'] = rows[-1][0]
+            total += len(rows)
+        print(f'{table_name}: {total} entries indexed in '
+              f'{time.perf_counter() - start:.1f}s', file=report)
+
+
+@db_session
+def prune_index():
+    """
+    Removes the entries deleted without going through PonyTable (e.g. by
+    a cascade) from the index and returns their number. search skips them
+    in the meantime, as it only reads.
+    """
+    quote = db._db.provider.quote_name
+    mask = (1 << ID_BITS) - 1
+    pruned = 0
+    numbers = dict(db._db.select(f'SELECT name, number FROM {ENTITY_TABLE}'))
+    for table_name, number in numbers.items():
+        offset = number << ID_BITS
+        if table_name in entities:
+            entity = entities[table_name]
+            existing = (f'AND (rowid & {mask}) NOT IN '
+                        f'(SELECT {quote(entity._pk_columns_[0])} '
+                        f'FROM {quote(entity._table_)})')
+        else:
+            existing = ''
+        pruned += db._db.execute(
+            f'DELETE FROM {INDEX_TABLE} WHERE rowid BETWEEN {offset} '
+            f'AND {offset | mask} {existing}').rowcount
+    return pruned
+
+
+def ensure_index(report=sys.stderr):
+    """
+    Builds the index unless it exists already, in which case the entries
+    deleted meanwhile are pruned from it.
+    """
+    if not index_exists():
+        build_index(report)
+    else:
+        prune_index()
+
+
+def update_index(action, entry):
+    """
+    Writes an entry added, modified or deleted by PonyTable to the index,
+    within the same transaction. Does nothing while there is no index.
+    """
+    table_name = type(entry).__name__
+    attrs = text_columns(table_name)
+    if not attrs or not index_exists():
+        return
+    params = {'rowid': _entity_number(table_name) << ID_BITS | entry.id}
+    db._db.execute(f'DELETE FROM {INDEX_TABLE} WHERE rowid = $rowid', params)
+    if action != 'delete':
+        params['text'] = _text(getattr(entry, attr.name) for attr in attrs)
+        db._db.execute(f'INSERT INTO {INDEX_TABLE} (rowid, text) '
+                       'VALUES ($rowid, $text)', params)
+
+
+def update_index_many(action, table_name, ids):
+    """Like update_index for the rows of table_name written in bulk."""
+    attrs = text_columns(table_name)
+    if not attrs or not index_exists():
+        return
+    quote = db._db.provider.quote_name
+    entity = entities[table_name]
+    id_col = quote(entity._pk_columns_[0])
+    offset = _entity_number(table_name) << ID_BITS
+    for start in range(0, len(ids), IN_BATCH_SIZE):
+        batch = ids[start:start + IN_BATCH_SIZE]
+        db._db.execute(f'DELETE FROM {INDEX_TABLE} WHERE rowid IN '
+                       f'({", ".join(str(offset | id_) for id_ in batch)})')
+        if action == 'delete':
+            continue
+        rows = db._db.select(
+            f'SELECT {id_col}, '
+            f'{", ".join(quote(a.column) for a in attrs)} '
+            f'FROM {quote(entity._table_)} '
+            f'WHERE {id_col} IN ({", ".join(map(str, batch))})')
+        db._db.get_connection().executemany(
+            f'INSERT INTO {INDEX_TABLE} (rowid, text) VALUES (?, ?)',
+            [(offset | row[0], _text(row[1:])) for row in rows])
+
+
+write_listeners.append(update_index)
+bulk_write_listeners.append(update_index_many)
+
+
+def _match_expression(query):
+    """Matches entries containing words starting with every query word."""
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+@read_session
+def search(query, limit=SEARCH_LIMIT):
+    """
+    Returns (repr, snippet) pairs of the best matching entries of every
+    entity, the reprs being those understood by get_entry_from_repr.
+    Entries deleted without going through PonyTable (e.g. by a cascade) are
+    dropped from the results until prune_index removes them.
+    """
+    expression = _match_expression(query)
+    if not expression:
+        return []
+    rows = db._db.select(
+        f"SELECT rowid, snippet({INDEX_TABLE}, 0, '', '', '...', 12) "
+        f'FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH $expression '
+        'ORDER BY rank LIMIT $limit',
+        {'expression': expression, 'limit': limit})
+    if not _numbers:
+        _numbers.update(db._db.select(
+            f'SELECT name, number FROM {ENTITY_TABLE}'))
+    names = {number: name for name, number in _numbers.items()}
+    mask = (1 << ID_BITS) - 1
+    ids = defaultdict(list)
+    for rowid, _ in rows:
+        ids[names.get(rowid >> ID_BITS)].append(rowid & mask)
+    quote = db._db.provider.quote_name
+    existing = set()
+    for table_name, table_ids in ids.items():
+        if table_name not in entities:
+            continue
+        entity = entities[table_name]
+        id_col = quote(entity._pk_columns_[0])
+        found = db._db.select(
+            f'SELECT {id_col} FROM {quote(entity._table_)} '
+            f'WHERE {id_col} IN ({", ".join(map(str, table_ids))})')
+        offset = _numbers[table_name] << ID_BITS
+        existing.update(offset | id_ for id_ in found)
+    return [(f'<{names[rowid >> ID_BITS]}[{rowid & mask}]>', snippet)
+            for rowid, snippet in rows if rowid in existing]
+
+
+def search_options(query, limit=SEARCH_LIMIT):
+    """Returns the results of search as dropdown options."""
+    return [{'label': f'{entry_repr} {snippet}', 'value': entry_repr}
+            for entry_repr, snippet in search(query, limit)]
+
+
+if __name__ == '__main__':
+    parser = argument_parser('Builds and queries a full-text index over the '
+                             'text columns of every entity')
+    parser.add_argument('query', nargs='?', help='words to search for')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the index before searching')
+    parser.add_argument('--limit', type=int, default=SEARCH_LIMIT)
+    args = parser.parse_args()
+    use_definition(args.definition)
+    if args.rebuild:
+        build_index()
+    else:
+        ensure_index()
+    if args.query:
+        for entry_repr, snippet in search(args.query, args.limit):
+            print(entry_repr, snippet)
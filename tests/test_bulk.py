@@ -0,0 +1,48 @@
+import datetime as dtt
+from pathlib import Path
+
+import pytest
+from pony.orm import db_session
+
+from pony_utils import db_loader
+from pony_utils.bulk import bulk_set, parse_ids
+
+EXAMPLE = Path(__file__).parent.parent / 'graph_examples' / \
+    'complex_example.py'
+
+
+@pytest.fixture
+def entities():
+    """Pins the in-memory example database with one Table6 row."""
+    entities = db_loader.use_definition(str(EXAMPLE))[2]
+    with db_session:
+        for entity in entities.values():
+            entity.select().delete(bulk=True)
+        table1 = entities['Table1'](attr0='a')
+        entities['Table6'](
+            id=1, description='d',
+            table2=entities['Table2'](name='n', table1=table1),
+            table3=entities['Table3'](name='n'),
+            table8=entities['Table8'](name='n', is_true=True,
+                                      is_false=False),
+            table10=entities['Table10'](name='n'),
+            date_opened=dtt.datetime(2021, 1, 1))
+    yield entities
+    db_loader._loaded = None
+
+
+def test_bulk_set_clears_reference(entities):
+    bulk_set('Table6', 'table10', 'None', ids=[1])
+    with db_session:
+        assert entities['Table6'][1].table10 is None
+
+
+def test_bulk_set_required_reference(entities):
+    with pytest.raises(ValueError, match='required'):
+        bulk_set('Table6', 'table8', 'None', ids=[1])
+
+
+def test_parse_ids():
+    assert parse_ids('1, 4-6 9') == [1, 4, 5, 6, 9]
+    with pytest.raises(ValueError, match='Reversed'):
+        parse_ids('5-1')
@@ -0,0 +1,73 @@
+import pytest
+from pony.orm import db_session, flush
+
+from pony_utils import db_loader
+from pony_utils.export import export, deferred_references
+from pony_utils.load import restore
+
+CYCLIC_DEFINITION = '''
+from pony import orm
+from pony.orm import Required, Optional, Set, db_session
+
+_db = orm.Database()
+
+
+class A(_db.Entity):
+    name = Required(str)
+    b = Optional('B', reverse='as_')
+    bs = Set('B', reverse='a')
+    parent = Optional('A', reverse='children')
+    children = Set('A', reverse='parent')
+
+
+class B(_db.Entity):
+    name = Required(str)
+    a = Required(A, reverse='bs')
+    as_ = Set(A, reverse='b')
+
+
+_db.bind(provider='sqlite', filename={filename!r}, create_db=True)
+_db.generate_mapping(create_tables=True)
+entities = _db.entities
+'''
+
+
+@pytest.fixture
+def definition(tmp_path):
+    """Returns a function writing and pinning a cyclic definition."""
+    def use(name):
+        path = tmp_path / f'{name}.py'
+        path.write_text(CYCLIC_DEFINITION.format(
+            filename=str(tmp_path / f'{name}.sqlite')))
+        return db_loader.use_definition(str(path))[2]
+    yield use
+    db_loader._loaded = None
+
+
+def _contents(entities):
+    with db_session:
+        return (sorted((a.id, a.name, a.b and a.b.id,
+                        a.parent and a.parent.id)
+                       for a in entities['A'].select()),
+                sorted((b.id, b.name, b.a.id)
+                       for b in entities['B'].select()))
+
+
+def test_cyclic_round_trip(definition, tmp_path):
+    entities = definition('source')
+    with db_session:
+        a1 = entities['A'](name='a1')
+        a2 = entities['A'](name='a2')
+        b1 = entities['B'](name='b1', a=a2)
+        entities['B'](name='b2', a=a1)
+        flush()
+        a1.b, a1.parent, a2.parent = b1, a2, a1
+    assert {f'{attr.entity.__name__}.{attr.name}'
+            for attr in deferred_references()} == {'A.b', 'A.parent'}
+    dump = str(tmp_path / 'dump.jsonl')
+    export(dump, chunk_size=1, report=None)
+    expected = _contents(entities)
+
+    restored = definition('target')
+    restore(dump, batch_size=1, report=None)
+    assert _contents(restored) == expected
@@ -1,23 +1,94 @@
-import graphviz as gv
+import hashlib
+import re
+import shutil
+import tempfile
+from pathlib import Path
 
 try:
-    from .db_loader import db, db_session, entities
+    from .db_loader import db, argument_parser, use_definition
 except ModuleNotFoundError:
-    from db_loader import db, db_session, entities
+    from db_loader import db, argument_parser, use_definition
+
+CACHE_DIR = Path(tempfile.gettempdir()) / 'pony_utils_vis'
 
 
 def get_port(s):
     return 'port="' + s.replace(' ', '_') + '"'
 
 
-def calculate_graph():
+def get_references(entity):
+    """Returns the attributes of entity that point to another entity."""
+    return [attr for attr in db.entities[entity]._attrs_
+            if attr.py_type in db.entities.values()]
+
+
+def get_sections():
+    """
+    Maps each entity to the banner section of the definition module it is
+    defined in, i.e. the NAME of the last
+
+        ##########
+        # NAME
+        ##########
+
+    block above its class statement.
+    """
+    sections = {}
+    section = None
+    previous = ''
+    with open(db.__file__) as f:
+        for line in f:
+            line = line.strip()
+            if re.fullmatch(r'#+', previous) and line.startswith('#') and \
+                    not re.fullmatch(r'#+', line):
+                section = line.lstrip('#').strip()
+            match = re.match(r'class (\w+)\b', line)
+            if match and match.group(1) in db.entities:
+                sections[match.group(1)] = section
+            previous = line
+    return sections
+
+
+def get_neighbourhood(focus, hops):
+    """
+    Returns focus together with every entity that is at most hops
+    references away from it, in either direction.
+    """
+    neighbours = {entity: set() for entity in db.entities}
+    for entity in db.entities:
+        for attr in get_references(entity):
+            neighbours[entity].add(attr.py_type.__name__)
+            neighbours[attr.py_type.__name__].add(entity)
+    if focus not in neighbours:
+        raise ValueError(f'Unknown entity {focus}')
+    found = {focus}
+    frontier = {focus}
+    for _ in range(hops):
+        frontier = {n for entity in frontier for n in neighbours[entity]}
+        frontier -= found
+        found |= frontier
+    return [entity for entity in db.entities if entity in found]
+
 
-    s = gv.Graph('graph', node_attr={'shape': 'plaintext'}, engine='neato',
+def calculate_graph(focus=None, hops=1, cluster=False, engine=None):
+    """
+    Returns the schema as a graphviz Graph. focus restricts it to an entity
+    and its neighbourhood of hops references and cluster groups the
+    entities by the section of the definition they are defined in.
+    Clusters are only drawn by the dot engine, which is then the default.
+    """
+    import graphviz as gv
+
+    engine = engine or ('dot' if cluster else 'neato')
+    s = gv.Graph('graph', node_attr={'shape': 'plaintext'}, engine=engine,
                  graph_attr={'splines': 'true', 'overlap': 'false'})
 
+    names = get_neighbourhood(focus, hops) if focus else list(db.entities)
+    sections = get_sections() if cluster else {}
+    subgraphs = {}
     edges = []
 
-    for entity in db.entities:
+    for entity in names:
 
         table_def = '<table border="0" cellborder="1" cellspacing="0">'
         header = (f'<tr><td bgcolor="black"><font color="white">{entity}'
@@ -28,19 +99,86 @@ def calculate_graph():
             name = attr.name
             port = get_port(name)
             attrs += f'<tr><td {port}>{name}</td></tr>'
-            # if isinstance(attr, db.Set):
-            if attr.py_type in db.entities.values():
+        for attr in get_references(entity):
+            if attr.py_type.__name__ in names:
                 edges.append((f'{entity}:{attr.name}',
                               f'{attr.py_type.__name__}:id'))
 
         s_struct = '<' + table_def + header + attrs + '</table>>'
-        s.node(entity, s_struct)
+        section = sections.get(entity)
+        if section is None:
+            s.node(entity, s_struct)
+        else:
+            if section not in subgraphs:
+                subgraphs[section] = gv.Graph(
+                    f'cluster_{len(subgraphs)}', graph_attr={'label': section})
+            subgraphs[section].node(entity, s_struct)
 
+    for subgraph in subgraphs.values():
+        s.subgraph(subgraph)
     s.edges(edges)
 
     s.attr(overlap='false')
-    s.view(directory='/tmp/')
+    return s
+
+
+def schema_signature(*options):
+    """
+    Hashes the entities, their attributes and references together with the
+    rendering options, so unchanged schemas can reuse a previous render.
+    """
+    h = hashlib.sha256(repr(options).encode())
+    for entity in db.entities:
+        h.update(entity.encode())
+        for attr in db.entities[entity]._attrs_:
+            h.update(f'|{attr.name}:{getattr(attr.py_type, "__name__", "")}'
+                     .encode())
+    return h.hexdigest()
+
+
+def render(output, fmt='svg', focus=None, hops=1, cluster=False, engine=None,
+           cache_dir=CACHE_DIR):
+    """
+    Writes the schema diagram to output without opening a viewer. fmt is
+    'dot' for the graphviz source or any graphviz output format. Renders
+    are cached in cache_dir by schema_signature.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    sections = sorted(get_sections().items()) if cluster else None
+    options = (fmt, focus, hops, sections, engine)
+    cached = cache_dir / f'{schema_signature(*options)}.{fmt}'
+    if not cached.exists():
+        s = calculate_graph(focus, hops, cluster, engine)
+        data = s.source.encode() if fmt == 'dot' else s.pipe(format=fmt)
+        tmp = cached.with_suffix(f'.{fmt}.tmp')
+        tmp.write_bytes(data)
+        tmp.replace(cached)
+    shutil.copyfile(cached, output)
+    return output
 
 
 if __name__ == '__main__':
-    calculate_graph()
+    parser = argument_parser('Draws a diagram of the database schema')
+    parser.add_argument('--output', help='file to write the diagram to '
+                                         'instead of opening a viewer')
+    parser.add_argument('--format',
+                        help='dot, svg, png, ... (default: output suffix)')
+    parser.add_argument('--focus', help='only draw this entity and its '
+                                        'neighbourhood')
+    parser.add_argument('--hops', type=int, default=1,
+                        help='size of the neighbourhood drawn with --focus')
+    parser.add_argument('--cluster', action='store_true',
+                        help='group entities by the section of the '
+                             'definition module they are defined in')
+    parser.add_argument('--engine', help='graphviz layout engine (default: '
+                                         'dot with --cluster, neato else)')
+    args = parser.parse_args()
+    use_definition(args.definition)
+    if args.output:
+        fmt = args.format or Path(args.output).suffix.lstrip('.') or 'svg'
+        render(args.output, fmt, args.focus, args.hops, args.cluster,
+               args.engine)
+    else:
+        calculate_graph(args.focus, args.hops, args.cluster,
+                        args.engine).view(directory='/tmp/')